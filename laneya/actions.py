@@ -8,20 +8,43 @@ The actual processing of actions happens in the server and client.
 """
 
 
-def move(direction=None):
+def handshake(compression=None):
+    """Negotiate options for the connection.
+
+    ``compression`` may be ``'zlib'``.  The response contains the
+    compression that the server accepted.  If it is set, all data that the
+    server sends after the response is compressed.
+    """
+    assert compression in [None, 'zlib']
+
+
+def datagram():
+    """Ask for a token to authenticate an unreliable datagram channel.
+
+    The response contains ``token`` and ``port``.  The client sends the
+    token as a datagram to that port on the server.  From then on, the
+    server may send ``positions`` updates as datagrams.
+    """
+
+
+def move(direction=None, seq=None):
     """Start moving in the defined direction.
 
     This message is primarily useful for clients that want to move their users
     on the map.  They can easily convert key press events to ``move``
     messages.
 
-    I might be worth to also broadcast these messages so clients can
-    interpolate a user's movement.  ``move`` messages are however not fit to
-    handle the actual movement of entities because clients may run with
-    different speeds. The ``position`` message should be used instead.
+    ``move`` messages are not fit to handle the actual movement of entities
+    because clients may run with different speeds. The ``positions`` message
+    should be used instead.  Clients may however predict the movement of
+    their own user.  The optional ``seq`` is an increasing sequence number
+    that the server echoes in ``positions`` so clients can tell which of
+    their inputs have already been processed.  It has to fit into an
+    unsigned 32 bit integer.
 
     """
     assert direction in ['north', 'east', 'south', 'west', 'stop']
+    assert seq is None or (isinstance(seq, int) and 0 <= seq < 2 ** 32)
 
 
 def position(x=None, y=None, entity=None):
@@ -30,6 +53,19 @@ def position(x=None, y=None, entity=None):
     assert isinstance(y, int)
 
 
+def positions(positions=None):
+    """Set the positions of multiple entities.
+
+    ``positions`` is a list of ``[entity, x, y, seq]`` entries where ``seq``
+    is the sequence number of the last ``move`` processed for that entity.
+    """
+    assert isinstance(positions, list)
+    for entity, x, y, seq in positions:
+        assert isinstance(x, int)
+        assert isinstance(y, int)
+        assert isinstance(seq, int)
+
+
 def logout():
     """Delete the requesting user.
 
@@ -37,6 +73,31 @@ def logout():
     """
 
 
-def get_map(map_id):
-    """Ask the server to send a serialisation of the specified map."""
-    pass
+def get_map(map_id, version=None, key=None):
+    """Ask the server to send a serialisation of the specified map.
+
+    By default, this is the map the user is on.  ``key`` may be the
+    ``[X, Y, Z]`` coordinates of the map or one of its direct neighbours so
+    clients can prefetch maps before the user enters them.  Neighbours are
+    only sent if the server has already generated them.
+
+    The response contains the map's content ``version``, its ``key`` and the
+    ``world`` it belongs to.  If the client already has the map in
+    ``version``, the server responds with ``not_modified`` instead of the
+    map.
+    """
+    assert version is None or isinstance(version, int)
+    if key is not None:
+        assert isinstance(key, list) and len(key) == 3
+        assert all(isinstance(i, int) for i in key)
+
+
+def memory(token=None):
+    """Get a report of the server's memory usage.
+
+    This is only allowed for admins, who prove that with the secret
+    ``token`` the server was started with.  The report attributes bytes to
+    maps, sprites, users and connections and shows how much each of them has
+    grown since the previous report.
+    """
+    assert token is None or isinstance(token, str)
@@ -0,0 +1,107 @@
+"""Client side cache of map tiles.
+
+Maps hardly ever change, so the client keeps every map it has seen on disk
+and only asks the server whether its copy is still up to date.  There is one
+:py:class:`laneya.store.WorldStore` per world (as identified by the ``world``
+field of ``get_map`` responses, which is derived from the server's seed).
+The content version of a cached map is the checksum of its tile codes, just
+like :py:attr:`laneya.map.Map.version` on the server.
+
+The cache also remembers on which map the user was on each server, so the
+client can draw it right away on the next start.
+
+"""
+
+import os
+import json
+import zlib
+
+from .store import WorldStore, encode_tiles, decode_tiles
+
+
+def get_default_directory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'laneya')
+
+
+class MapCache(object):
+    def __init__(self, directory=None):
+        self.directory = directory or get_default_directory()
+        self.worlds = {}
+        self._last = None
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def _open(self, world, width=None, height=None):
+        if world not in self.worlds:
+            filename = os.path.join(self.directory, '%s.world' % world)
+            if width is None and not os.path.exists(filename):
+                return None
+            checksum = int(world, 16)
+            try:
+                self.worlds[world] = WorldStore(
+                    filename, width, height, world=checksum)
+            except ValueError:
+                # the map size has changed; start over
+                os.remove(filename)
+                self.worlds[world] = WorldStore(
+                    filename, width, height, world=checksum)
+        return self.worlds[world]
+
+    def get(self, world, key):
+        """Get ``(version, floor_layer)`` of a cached map or ``None``."""
+        store = self._open(world)
+        if store is not None:
+            tiles = store.get(*key)
+            if tiles is not None:
+                floor_layer = decode_tiles(tiles, store.width, store.height)
+                return zlib.crc32(tiles), floor_layer
+
+    def get_version(self, world, key):
+        """Get the version of a cached map or ``None``."""
+        store = self._open(world)
+        if store is not None:
+            tiles = store.get(*key)
+            if tiles is not None:
+                return zlib.crc32(tiles)
+
+    def put(self, world, key, floor_layer):
+        store = self._open(world, len(floor_layer), len(floor_layer[0]))
+        tiles = encode_tiles(floor_layer)
+        if store.get(*key) != tiles:
+            store.put(*key, tiles)
+
+    @property
+    def last(self):
+        if self._last is None:
+            self._last = {}
+            filename = os.path.join(self.directory, 'last')
+            if os.path.exists(filename):
+                with open(filename) as fh:
+                    self._last = json.load(fh)
+        return self._last
+
+    def get_last(self, address):
+        """Get ``(world, key)`` of the last map the user was on or ``None``."""
+        if address in self.last:
+            world, X, Y, Z = self.last[address]
+            return world, (X, Y, Z)
+
+    def set_last(self, address, world, key):
+        if self.get_last(address) == (world, tuple(key)):
+            return
+        self.last[address] = [world] + list(key)
+        filename = os.path.join(self.directory, 'last')
+        with open(filename + '.tmp', 'w') as fh:
+            json.dump(self.last, fh)
+        os.replace(filename + '.tmp', filename)
+
+    def close(self):
+        for store in self.worlds.values():
+            store.close()
+        self.worlds = {}
+
+
+__all__ = ['MapCache']
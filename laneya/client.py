@@ -1,67 +1,279 @@
+import asyncio
+import argparse
+
 from dirtywords import Screen
 
 from . import protocol
-from .protocol import asyncio
+from .cache import MapCache
+from .map import DELTAS, DIRECTION_CODES
 
 screen = Screen(40, 60)
 screen.border()
 
+# neighbouring maps are prefetched when the user is this close to the edge
+PREFETCH_DISTANCE = 5
+
+
+def get_outline(floor_layer):
+    """Get all walls that are next to at least one non-wall field.
+
+    Instead of checking all 8 neighbours of every field one by one, the number
+    of walls in every 3x3 neighbourhood is computed by summing shifted copies
+    of a padded wall grid, first along columns and then across them.
+
+    """
+    height = len(floor_layer[0])
+    border = [1] * (height + 2)
+    walls = [border] + [
+        [1] + [int(field == 'wall') for field in column] + [1]
+        for column in floor_layer] + [border]
+
+    vertical = [
+        [a + b + c for a, b, c in zip(column, column[1:], column[2:])]
+        for column in walls]
+    total = [
+        [a + b + c for a, b, c in zip(*columns)]
+        for columns in zip(vertical, vertical[1:], vertical[2:])]
+
+    return set(
+        (x, y)
+        for x, column in enumerate(total)
+        for y, count in enumerate(column)
+        if count < 9 and floor_layer[x][y] == 'wall')
+
 
 class Client(protocol.ClientProtocolFactory):
-    def __init__(self, loop):
+    """Terminal client.
+
+    The position of the local user is *predicted*:  Its movement is simulated
+    locally against the cached floor layer and corrected by the server only
+    once the server has processed the latest ``move`` request (as identified
+    by its sequence number).  While moving, the server's positions lag
+    behind the prediction by one round trip, so positions that are behind
+    the prediction along the current direction are ignored until the user
+    stops.
+
+    Remote entities are *interpolated* between the positions received from
+    the server over the duration of one server tick.
+
+    Maps are kept in a :py:class:`laneya.cache.MapCache` if one is passed.
+    The last known map is drawn from the cache before the server has
+    confirmed that it is up to date, and neighbouring maps are prefetched
+    while the user is close to an edge.
+
+    """
+
+    def __init__(self, loop, cache=None):
         super(Client, self).__init__(loop)
         self.sprites = {}
+        self.interpolating = set()
+        self.floor_layer = None
+        self.outline = set()
+        self.dirty = set()
+        self.direction = 'stop'
+        self.seq = 0
+        self.host = None
+        self.port = None
+        self.cache = cache
+        self.world = None
+        self.key = None
+        self.prefetched = set()
+
+    def setup(self, user):
+        super(Client, self).setup(user)
+        self.entity = 'User:%s' % user
+
+    @property
+    def address(self):
+        return '%s:%s' % (self.host, self.port)
 
     def connection_made(self):
-        self.send_request('get_map', map_id='example_map')\
-            .then(lambda response: self.render_floor(response['data']))
-
-    def render_floor(self, data):
-        floor_layer = data['floor_layer']
-        width = len(floor_layer)
-        height = len(floor_layer[0])
-
-        def is_wall(x, y):
-            return (
-                x < 0 or x >= width or
-                y < 0 or y >= height or
-                floor_layer[x][y] == 'wall'
-            )
-
-        def sorrunded(x, y):
-            return (
-                is_wall(x - 1, y) and
-                is_wall(x - 1, y - 1) and
-                is_wall(x - 1, y + 1) and
-                is_wall(x, y - 1) and
-                is_wall(x + 1, y) and
-                is_wall(x, y + 1) and
-                is_wall(x + 1, y - 1) and
-                is_wall(x + 1, y + 1)
-            )
-
-        for x, column in enumerate(floor_layer):
-            for y, field in enumerate(column):
-                if field == 'wall':
-                    if not sorrunded(x, y):
-                        screen.putstr(y, x, '#')
+        self.handshake('zlib')
+        self.loop.create_task(self.open_datagram_channel(self.host))
+
+        version = None
+        if self.cache is not None:
+            last = self.cache.get_last(self.address)
+            cached = self.cache.get(*last) if last else None
+            if cached is not None:
+                self.world, self.key = last
+                version, floor_layer = cached
+                self.render_floor(floor_layer)
+
+        self.send_request('get_map', map_id='example_map', version=version)\
+            .then(self._map_response)
+        # learn our own position so the first key press can be predicted
+        self.move('stop')
+
+    def _map_response(self, response):
+        data = response['data']
+        self.world = data['world']
+        self.key = tuple(data['key'])
+        if not data.get('not_modified'):
+            self.render_floor(data['floor_layer'])
+            if self.cache is not None:
+                self.cache.put(self.world, self.key, data['floor_layer'])
+        if self.cache is not None:
+            self.cache.set_last(self.address, self.world, self.key)
+
+    def _prefetch_response(self, response):
+        data = response['data']
+        if not data.get('not_modified'):
+            self.cache.put(data['world'], data['key'], data['floor_layer'])
+
+    def prefetch(self):
+        """Fetch the maps next to the user's map if the user is near them."""
+        if (self.cache is None or self.key is None or
+                self.entity not in self.sprites):
+            return
+
+        sprite = self.sprites[self.entity]
+        width = len(self.floor_layer)
+        height = len(self.floor_layer[0])
+        X, Y, Z = self.key
+
+        keys = []
+        if sprite['x'] < PREFETCH_DISTANCE:
+            keys.append((X - 1, Y, Z))
+        if sprite['x'] >= width - PREFETCH_DISTANCE:
+            keys.append((X + 1, Y, Z))
+        if sprite['y'] < PREFETCH_DISTANCE:
+            keys.append((X, Y - 1, Z))
+        if sprite['y'] >= height - PREFETCH_DISTANCE:
+            keys.append((X, Y + 1, Z))
+
+        for key in keys:
+            if key not in self.prefetched:
+                self.prefetched.add(key)
+                version = self.cache.get_version(self.world, key)
+                self.send_request(
+                    'get_map', map_id='', key=list(key), version=version,
+                ).then(self._prefetch_response)
+
+    def render_floor(self, floor_layer):
+        # clear the outline of the previous map
+        self.dirty.update(self.outline)
+        self.floor_layer = floor_layer
+        self.outline = get_outline(self.floor_layer)
+        self.dirty.update(self.outline)
+
+    def draw_position(self, entity, x, y):
+        sprite = self.sprites[entity]
+        if (sprite['x'], sprite['y']) != (x, y):
+            self.dirty.add((sprite['x'], sprite['y']))
+            self.dirty.add((x, y))
+            sprite['x'] = x
+            sprite['y'] = y
+
+    def set_position(self, entity, x, y, seq=0):
+        if entity not in self.sprites:
+            self.sprites[entity] = {'x': x, 'y': y}
+            self.dirty.add((x, y))
+        elif entity == self.entity:
+            # the server has not yet seen our latest input, so our own
+            # prediction is more up to date
+            if seq >= self.seq and not self.is_behind(x, y):
+                self.draw_position(entity, x, y)
+        else:
+            sprite = self.sprites[entity]
+            sprite['from'] = (sprite['x'], sprite['y'])
+            sprite['to'] = (x, y)
+            sprite['time'] = self.loop.time()
+            self.interpolating.add(entity)
+
+    def is_behind(self, x, y):
+        """Check whether (x, y) is behind the predicted position.
+
+        That is the case if the local user can reach the predicted position
+        from (x, y) by moving on in the current direction.
+        """
+        if self.direction == 'stop':
+            return False
+        sprite = self.sprites[self.entity]
+        dx, dy = DELTAS[DIRECTION_CODES[self.direction]]
+        steps = (sprite['x'] - x) * dx + (sprite['y'] - y) * dy
+        return steps > 0 and (sprite['x'], sprite['y']) == (
+            x + dx * steps, y + dy * steps)
+
+    def interpolate(self):
+        """Move remote entities towards their latest known position."""
+        now = self.loop.time()
+        for entity in list(self.interpolating):
+            sprite = self.sprites[entity]
+            (x0, y0), (x1, y1) = sprite['from'], sprite['to']
+            f = min(1, (now - sprite['time']) / protocol.TICK)
+            self.draw_position(
+                entity,
+                int(round(x0 + (x1 - x0) * f)),
+                int(round(y0 + (y1 - y0) * f)))
+            if f == 1:
+                self.interpolating.discard(entity)
+
+    def predict(self):
+        """Move the local user as the server is expected to."""
+        if (self.direction == 'stop' or self.floor_layer is None or
+                self.entity not in self.sprites):
+            return
+
+        sprite = self.sprites[self.entity]
+        dx, dy = DELTAS[DIRECTION_CODES[self.direction]]
+        x = sprite['x'] + dx
+        y = sprite['y'] + dy
+
+        occupied = any(
+            (other['x'], other['y']) == (x, y)
+            for other in self.sprites.values())
+        if (0 <= x < len(self.floor_layer) and
+                0 <= y < len(self.floor_layer[0]) and
+                self.floor_layer[x][y] == 'floor' and not occupied):
+            self.draw_position(self.entity, x, y)
 
     def update_received(self, action, **kwargs):  # TODO
-        if action == 'position':
-            entity = kwargs['entity']
-            if entity not in self.sprites:
-                self.sprites[entity] = {}
+        # only record the changes; they are drawn once per frame in
+        # :py:meth:`flush` so intermediate positions are never drawn
+        if action == 'positions':
+            for entity, x, y, seq in kwargs['positions']:
+                self.set_position(entity, x, y, seq)
+
+    def flush(self):
+        """Redraw all dirty fields and refresh the screen."""
+        if not self.dirty:
+            return
+
+        occupied = {}
+        for entity, sprite in self.sprites.items():
+            occupied[(sprite['x'], sprite['y'])] = entity
+
+        for x, y in self.dirty:
+            if (x, y) in occupied:
+                screen.putstr(y, x, occupied[(x, y)][0])
+            elif (x, y) in self.outline:
+                screen.putstr(y, x, '#')
             else:
-                screen.delch(
-                    self.sprites[entity]['y'],
-                    self.sprites[entity]['x'])
-            self.sprites[entity]['x'] = kwargs['x']
-            self.sprites[entity]['y'] = kwargs['y']
-            screen.putstr(kwargs['y'], kwargs['x'], entity[0])
+                screen.delch(y, x)
+
+        self.dirty.clear()
         screen.refresh()
 
+    def _move_response(self, response):
+        data = response['data']
+        if data.get('coalesced'):
+            # superseded by a later move; there is no position
+            return
+        elif self.entity not in self.sprites:
+            # the server only broadcasts sprites that move, so this may be
+            # the first time we learn about our own position
+            self.set_position(self.entity, data['x'], data['y'])
+        # once stopped, the server's position is final
+        elif data.get('seq') == self.seq and data['direction'] == 'stop':
+            self.draw_position(self.entity, data['x'], data['y'])
+
     def move(self, direction):
-        return self.send_request('move', direction=direction)
+        self.seq += 1
+        self.direction = direction
+        self.predict()
+        return self.send_request('move', direction=direction, seq=self.seq)\
+            .then(self._move_response)
 
     def mainloop(self):  # TODO
         for event in list(screen.get_key_events()):
@@ -77,25 +289,48 @@ class Client(protocol.ClientProtocolFactory):
                 self.send_request('logout')
                 raise KeyboardInterrupt
 
+        self.interpolate()
+        self.prefetch()
+        self.flush()
 
-def main():
-    loop = asyncio.get_event_loop()
 
-    client = Client(loop)
+async def play(host='localhost', port=5001, cache=None):
+    loop = asyncio.get_running_loop()
+
+    client = Client(loop, cache=cache)
     client.setup('testuser')
-    coro = loop.create_connection(client.build_protocol, 'localhost', 5001)
-    loop.run_until_complete(coro)
+    client.host = host
+    client.port = port
+    await loop.create_connection(client.build_protocol, host, port)
 
     mainloop = protocol.LoopingCall(loop, client.mainloop)
     mainloop.start(0.02)
 
+    prediction = protocol.LoopingCall(loop, client.predict)
+    prediction.start(protocol.TICK)
+
+    await mainloop.task
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--loop', choices=['auto', 'asyncio', 'uvloop'],
+        help='event loop implementation (default: $LANEYA_LOOP or auto)')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='do not keep maps in ~/.cache/laneya')
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else MapCache()
     try:
-        loop.run_forever()
+        protocol.run(play(cache=cache), loop=args.loop)
     except KeyboardInterrupt:
         pass
     finally:
         screen.cleanup()
-        loop.close()
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == '__main__':  # pragma: nocover
@@ -0,0 +1,125 @@
+"""Logging that does not block the event loop.
+
+Log records are put on a queue by the thread that creates them and written
+by a :py:class:`logging.handlers.QueueListener` in a background thread.
+Messages are not formatted before they reach that thread, so code should
+always pass arguments separately instead of formatting them itself::
+
+    logger.error('Invalid message: %s', message)
+
+Floods of similar records (e.g. from a client that sends garbage) are
+limited per category by :py:class:`RateLimitFilter` before they even reach
+the queue.  The category of a record is its ``category`` attribute (which
+can be set with ``extra``) or its unformatted message.
+
+"""
+
+import json
+import time
+import queue
+import logging
+import logging.handlers
+
+
+class RateLimitFilter(logging.Filter):
+    """Let only ``burst`` records per category pass every ``interval`` seconds.
+
+    After that, only every ``sample``-th record passes.  Passing records
+    have a ``suppressed`` attribute with the number of records of the same
+    category that were dropped before them.
+
+    """
+
+    def __init__(self, burst=10, interval=1, sample=100, clock=time.monotonic):
+        super(RateLimitFilter, self).__init__()
+        self.burst = burst
+        self.interval = interval
+        self.sample = sample
+        self.clock = clock
+        self.windows = {}
+
+    def filter(self, record):
+        category = getattr(record, 'category', record.msg)
+        now = self.clock()
+
+        start, count, suppressed = self.windows.get(category, (now, 0, 0))
+        if now - start >= self.interval:
+            start, count = now, 0
+        count += 1
+
+        if count <= self.burst or (count - self.burst) % self.sample == 0:
+            record.suppressed = suppressed
+            self.windows[category] = (start, count, 0)
+            return True
+        else:
+            self.windows[category] = (start, count, suppressed + 1)
+            return False
+
+
+class StructuredFormatter(logging.Formatter):
+    """Format records as JSON objects, one per line.
+
+    Fields that were passed with ``extra={'data': {...}}`` are included.
+    """
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'category', None):
+            data['category'] = record.category
+        if getattr(record, 'suppressed', 0):
+            data['suppressed'] = record.suppressed
+        if getattr(record, 'data', None):
+            data.update(record.data)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        s = super(TextFormatter, self).format(record)
+        if getattr(record, 'suppressed', 0):
+            s += ' (%i similar messages suppressed)' % record.suppressed
+        return s
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves formatting to the listener thread."""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=logging.INFO, structured=False, stream=None):
+    """Log the ``laneya`` logger in a background thread.
+
+    Returns the :py:class:`logging.handlers.QueueListener`.  Call its
+    ``stop()`` method on shutdown to write all pending records.
+
+    """
+    q = queue.SimpleQueue()
+
+    handler = LazyQueueHandler(q)
+    handler.addFilter(RateLimitFilter())
+
+    output = logging.StreamHandler(stream)
+    if structured:
+        output.setFormatter(StructuredFormatter())
+    else:
+        output.setFormatter(TextFormatter('%(asctime)s %(message)s'))
+
+    logger = logging.getLogger('laneya')
+    logger.setLevel(level)
+    logger.addHandler(handler)
+
+    listener = logging.handlers.QueueListener(q, output)
+    listener.start()
+    return listener
+
+
+__all__ = ['RateLimitFilter', 'StructuredFormatter', 'setup_logging']
@@ -1,7 +1,16 @@
 import os
 import json
+import zlib
+import heapq
 import random
 
+from .store import WorldStore, encode_tiles, decode_tiles, seed_checksum
+
+STOP, NORTH, EAST, SOUTH, WEST = range(5)
+DIRECTIONS = ['stop', 'north', 'east', 'south', 'west']
+DIRECTION_CODES = {name: code for code, name in enumerate(DIRECTIONS)}
+DELTAS = [(0, 0), (0, -1), (1, 0), (0, 1), (-1, 0)]
+
 
 def collision_free(room, other):
     return (
@@ -21,109 +30,219 @@ def in_room(x, y, room):
     )
 
 
+def generate_rooms(rand, width, height):
+    rooms = []
+
+    # make sure user and ghost are inside of a room
+    rooms.append({
+        'x_min': 5,
+        'x_max': 20,
+        'y_min': 5,
+        'y_max': 20,
+    })
+
+    for i in range(2000):
+        x1 = rand.randint(1, width - 2)
+        x2 = rand.randint(1, width - 2)
+        y1 = rand.randint(1, height - 2)
+        y2 = rand.randint(1, height - 2)
+
+        room = {
+            'x_min': min(x1, x2),
+            'x_max': max(x1, x2),
+            'y_min': min(y1, y2),
+            'y_max': max(y1, y2),
+        }
+
+        if (room['x_max'] - room['x_min'] > 2 and
+                room['y_max'] - room['y_min'] > 2):
+            if all(collision_free(room, other) for other in rooms):
+                rooms.append(room)
+
+    return rooms
+
+
+def generate_floor(seed, X, Y, Z, width, height):
+    """Generate the floor layer of a map.
+
+    The result only depends on the arguments, so this can safely be run in
+    parallel in other processes.
+
+    """
+    rand = random.Random('%s:%i:%i:%i' % (seed, X, Y, Z))
+    floor_layer = [[None for i in range(height)] for i in range(width)]
+    rooms = generate_rooms(rand, width, height)
+
+    # carve rooms
+    for x in range(width):
+        for y in range(height):
+            if any((in_room(x, y, room) for room in rooms)):
+                floor_layer[x][y] = 'floor'
+            else:
+                floor_layer[x][y] = 'wall'
+
+    # carve paths
+    for i, room in enumerate(rooms):
+        if i != 0:
+            last = rooms[i - 1]
+
+            x_center = (room['x_max'] + room['x_min']) // 2
+            y_center = (room['y_max'] + room['y_min']) // 2
+            last_x_center = (last['x_max'] + last['x_min']) // 2
+            last_y_center = (last['y_max'] + last['y_min']) // 2
+
+            x_min = min(x_center, last_x_center)
+            x_max = max(x_center, last_x_center) + 1
+            y_min = min(y_center, last_y_center)
+            y_max = max(y_center, last_y_center) + 1
+
+            for x in range(x_min, x_max):
+                floor_layer[x][last_y_center] = 'floor'
+
+            for y in range(y_min, y_max):
+                floor_layer[x_center][y] = 'floor'
+
+    return floor_layer
+
+
 class MapManager(object):
     """Manager that takes care of generating and storing all maps.
 
     All maps have the same width/height and identified by X, Y and Z
     coordinates. At any combination of coordinates, there can be only one map.
 
+    If ``persist`` is set, maps are stored in a :py:class:`WorldStore` in the
+    ``maps`` directory.  The store can only be used with the seed it was
+    created for.
+
+    Maps are generated from the world ``seed`` and their coordinates, so the
+    same map is generated for the same coordinates on every server.
+
     """
-    def __init__(self, server, width=60, height=40, persist=True):
+    def __init__(self, server, width=60, height=40, persist=True, seed=0):
         self.server = server
         self.width = width
         self.height = height
         self.persist = persist
+        self.seed = seed
+        # identifies the world to clients without revealing the seed
+        self.world_id = '%08x' % seed_checksum(seed)
         self.store = {}
+        self._world = None
 
-    def generate_rooms(self):
-        rooms = []
-
-        # make sure user and ghost are inside of a room
-        rooms.append({
-            'x_min': 5,
-            'x_max': 20,
-            'y_min': 5,
-            'y_max': 20,
-        })
-
-        for i in range(2000):
-            x1 = random.randint(1, self.width - 2)
-            x2 = random.randint(1, self.width - 2)
-            y1 = random.randint(1, self.height - 2)
-            y2 = random.randint(1, self.height - 2)
-
-            room = {
-                'x_min': min(x1, x2),
-                'x_max': max(x1, x2),
-                'y_min': min(y1, y2),
-                'y_max': max(y1, y2),
-            }
-
-            if (room['x_max'] - room['x_min'] > 2 and
-                    room['y_max'] - room['y_min'] > 2):
-                if all(collision_free(room, other) for other in rooms):
-                    rooms.append(room)
-
-        return rooms
+    @property
+    def world(self):
+        if self._world is None:
+            if not os.path.exists('maps'):
+                os.mkdir('maps')
+            self._world = WorldStore(
+                'maps/world', self.width, self.height,
+                world=seed_checksum(self.seed))
+        return self._world
 
     def generate(self, X, Y, Z):
         """Generate a new map."""
 
         _map = Map(self.server, self.width, self.height)
-        rooms = self.generate_rooms()
-
-        # carve rooms
-        for x in range(self.width):
-            for y in range(self.height):
-                if any((in_room(x, y, room) for room in rooms)):
-                    _map.floor_layer[x][y] = 'floor'
-                else:
-                    _map.floor_layer[x][y] = 'wall'
-
-        # carve paths
-        for i, room in enumerate(rooms):
-            if i != 0:
-                last = rooms[i - 1]
-
-                x_center = (room['x_max'] + room['x_min']) // 2
-                y_center = (room['y_max'] + room['y_min']) // 2
-                last_x_center = (last['x_max'] + last['x_min']) // 2
-                last_y_center = (last['y_max'] + last['y_min']) // 2
-
-                x_min = min(x_center, last_x_center)
-                x_max = max(x_center, last_x_center) + 1
-                y_min = min(y_center, last_y_center)
-                y_max = max(y_center, last_y_center) + 1
+        _map.floor_layer = generate_floor(
+            self.seed, X, Y, Z, self.width, self.height)
+        return _map
 
-                for x in range(x_min, x_max):
-                    _map.floor_layer[x][last_y_center] = 'floor'
+    def pregenerate(self, keys, workers=None):
+        """Generate and store many maps in parallel.
 
-                for y in range(y_min, y_max):
-                    _map.floor_layer[x_center][y] = 'floor'
+        Maps that are already stored are skipped.  Returns the number of
+        generated maps.
 
-        return _map
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        keys = [key for key in keys if key not in self.world]
+        if not keys:
+            return 0
+
+        args = [
+            (self.seed, X, Y, Z, self.width, self.height)
+            for X, Y, Z in keys]
+
+        with ProcessPoolExecutor(workers) as executor:
+            floors = executor.map(generate_floor, *zip(*args))
+            self.world.put_many(
+                (key, encode_tiles(floor_layer))
+                for key, floor_layer in zip(keys, floors))
+
+        return len(keys)
+
+    def load(self, X, Y, Z):
+        """Load a map from disk or return ``None``."""
+        tiles = self.world.get(X, Y, Z)
+        if tiles is not None:
+            _map = Map(self.server, self.width, self.height)
+            _map.floor_layer = decode_tiles(tiles, self.width, self.height)
+            return _map
+
+        # migrate maps from the old one-file-per-map format
+        filename = 'maps/%i:%i:%i.map' % (X, Y, Z)
+        if os.path.exists(filename):
+            _map = Map(self.server, self.width, self.height)
+            _map.load(filename)
+            self.world.put(X, Y, Z, encode_tiles(_map.floor_layer))
+            return _map
 
     def get(self, X, Y, Z):
         """Get a map.  If it does not exist yet, generate one."""
 
-        key = '%i:%i:%i' % (X, Y, Z)
-        filename = 'maps/%s.map' % key
+        key = (X, Y, Z)
 
         if key not in self.store:
-            if not os.path.exists('maps'):
-                os.mkdir('maps')
+            _map = self.load(X, Y, Z) if self.persist else None
 
-            if os.path.exists(filename):
-                _map = Map(self.server, self.width, self.height)
-                _map.load(filename)
-            else:
+            if _map is None:
                 _map = self.generate(X, Y, Z)
-                _map.dump(filename)
+                if self.persist:
+                    self.world.put(X, Y, Z, encode_tiles(_map.floor_layer))
 
+            _map.key = key
+            _map.world_id = self.world_id
+            _map.random.seed('%s:%i:%i:%i:sprites' % ((self.seed,) + key))
             self.store[key] = _map
 
         return self.store[key]
 
+    def peek(self, X, Y, Z):
+        """Get a map that is loaded or stored without keeping it loaded.
+
+        Returns ``None`` if the map would have to be generated first.
+        """
+        key = (X, Y, Z)
+        if key in self.store:
+            return self.store[key]
+
+        if self.persist:
+            _map = self.load(X, Y, Z)
+            if _map is not None:
+                _map.key = key
+                _map.world_id = self.world_id
+                return _map
+
+    def load_hot(self):
+        """Get the keys of the maps that were active on last shutdown."""
+        keys = []
+        if os.path.exists('maps/hot'):
+            with open('maps/hot') as fh:
+                for line in fh:
+                    keys.append(tuple(int(i) for i in line.split(':')))
+        return keys
+
+    def dump_hot(self, maps):
+        """Remember the keys of ``maps`` for the next startup."""
+        if not os.path.exists('maps'):
+            os.mkdir('maps')
+        with open('maps/hot.tmp', 'w') as fh:
+            for _map in maps:
+                fh.write('%i:%i:%i\n' % _map.key)
+        os.replace('maps/hot.tmp', 'maps/hot')
+
 
 class Map(object):
     """A singel map containing sprites.
@@ -135,56 +254,178 @@ class Map(object):
     The passed server is used to send updates to the clients.
 
     Map objects expose an API for the server (e.g. :py:meth:`step`) and another
-    one for sprites (e.g. :py:meth:`move_sprite`).
+    one for sprites (e.g. :py:meth:`move_sprites`).
 
     """
     def __init__(self, server, width, height):
         self.server = server
+        self.key = None
+        self.world_id = None
         self.width = width
         self.height = height
         self.sprites = {}
+        self.active = {}
+        self.tick = 0
+        self._wakeups = []
         self.movable_layer = [
             [None for i in range(height)] for i in range(width)]
         self.floor_layer = [
             [None for i in range(height)] for i in range(width)]
+        self._version = None
+        self._encoded = None
+        # sprites should use this instead of the global random module so
+        # that the simulation can be replayed
+        self.random = random.Random()
         self.ghost = Ghost('example', self, 15, 15)
 
     def step(self):
-        """Update this map and all of its sprites.
+        """Update this map and all of its active sprites.
 
         If this map is currently active (contains at least on user), the server
         should call this method once per mainloop cycle.
 
+        Only sprites that have been woken up (see :py:meth:`wake` and
+        :py:meth:`schedule`) are updated.  A sprite is only stepped on ticks
+        that are a multiple of its :py:attr:`Sprite.interval`.  Sprites that
+        are idle after their step are put back to sleep.
+
+        Movement is not performed by the sprites themselves.  Instead, all
+        sprites that want to move are collected and moved at once in
+        :py:meth:`move_sprites`.
+
         """
-        for sprite in self.sprites.values():
-            sprite.step()
+        self.tick += 1
+
+        while self._wakeups and self._wakeups[0][0] <= self.tick:
+            _, sprite_id = heapq.heappop(self._wakeups)
+            if sprite_id in self.sprites:
+                self.active[sprite_id] = self.sprites[sprite_id]
+
+        moving = []
+        for sprite in list(self.active.values()):
+            if self.tick % sprite.interval == 0:
+                sprite.step()
+                if sprite.direction != STOP:
+                    moving.append(sprite)
+            if sprite.is_idle():
+                self.active.pop(sprite.id, None)
+
+        if moving:
+            self.move_sprites(moving)
+
+    @property
+    def dirty(self):
+        """Whether there is anything to simulate on the next step."""
+        return bool(self.active or self._wakeups)
+
+    def wake(self, sprite):
+        """Make sure a sprite is updated on the next :py:meth:`step`."""
+        if sprite.id in self.sprites:
+            self.active[sprite.id] = sprite
+
+    def schedule(self, sprite, ticks):
+        """Wake a sprite up after the given number of ticks."""
+        heapq.heappush(self._wakeups, (self.tick + ticks, sprite.id))
+
+    def contains(self, x, y):
+        """Check whether field (x, y) is on this map."""
+        return 0 <= x < self.width and 0 <= y < self.height
 
     def is_collision_free(self, x, y):
         """Check whether a sprite can move to field (x, y)."""
         return (
+            self.contains(x, y) and
             self.movable_layer[x][y] is None and
             self.floor_layer[x][y] == 'floor')
 
-    def move_sprite(self, sprite, dx, dy):
-        """Move a sprite."""
-        if self.is_collision_free(sprite.x + dx, sprite.y + dy):
-            self.movable_layer[sprite.x][sprite.y] = None
-            sprite.x += dx
-            sprite.y += dy
-            self.movable_layer[sprite.x][sprite.y] = sprite
-            self.server.broadcast_update(
-                'position',
-                x=sprite.x,
-                y=sprite.y,
-                entity=sprite.id)
+    def move_sprites(self, sprites):
+        """Move multiple sprites one field in their direction at once.
+
+        Conflicts are resolved deterministically:  A sprite can only move to a
+        field that is collision free at the start of this phase and that has
+        not already been claimed by a sprite that comes earlier in
+        ``sprites``.
+
+        A single ``positions`` update is broadcasted for all moved sprites.
+        It includes the sequence number of the last input that was processed
+        for each sprite so clients can reconcile their predictions.
+
+        """
+        claimed = set()
+        moves = []
+
+        for sprite in sprites:
+            dx, dy = DELTAS[sprite.direction]
+            target = (sprite.x + dx, sprite.y + dy)
+            if target not in claimed and self.is_collision_free(*target):
+                claimed.add(target)
+                moves.append((sprite, target))
+
+        if not moves:
+            return
+
+        movable_layer = self.movable_layer
+        for sprite, target in moves:
+            if (self.contains(sprite.x, sprite.y) and
+                    movable_layer[sprite.x][sprite.y] is sprite):
+                movable_layer[sprite.x][sprite.y] = None
+        for sprite, (x, y) in moves:
+            sprite.x = x
+            sprite.y = y
+            movable_layer[x][y] = sprite
+
+        self.server.broadcast_update('positions', positions=[
+            [sprite.id, sprite.x, sprite.y, sprite.seq]
+            for sprite, target in moves])
+
+    @property
+    def version(self):
+        """Content version of the floor layer.
+
+        The version is derived from the tiles, so it stays the same across
+        server restarts as long as the tiles do not change.
+
+        """
+        if self._version is None:
+            self._version = zlib.crc32(encode_tiles(self.floor_layer))
+        return self._version
+
+    def invalidate(self):
+        """Drop cached data after the floor layer has changed."""
+        self._version = None
+        self._encoded = None
+
+    def set_tile(self, x, y, tile):
+        self.floor_layer[x][y] = tile
+        self.invalidate()
 
     def encode(self):
         return {
             'floor_layer': self.floor_layer,
         }
 
+    def get_info(self):
+        """Get the fields that identify this map and its content."""
+        return {
+            'version': self.version,
+            'key': self.key,
+            'world': self.world_id,
+        }
+
+    def encode_json(self):
+        """Get the JSON encoded :py:meth:`encode` and :py:meth:`get_info`.
+
+        The result is cached until the floor layer changes.
+        """
+        if self._encoded is None:
+            data = self.encode()
+            data.update(self.get_info())
+            self._encoded = json.dumps(data).encode('utf8')
+        return self._encoded
+
     def decode(self, data):
         self.floor_layer = data['floor_layer']
+        self.invalidate()
 
     def dump(self, filename):
         with open(filename, 'w') as fh:
@@ -198,27 +439,56 @@ class Map(object):
 class Sprite(object):
     """Simple base class for visible game objects."""
 
+    __slots__ = ('id', 'map', 'x', 'y', 'interval')
+
+    # sprites that can move overwrite this
+    direction = STOP
+
+    # sequence number of the last processed input
+    seq = 0
+
     def __init__(self, name, _map, x, y):
         self.id = "%s:%s" % (self.__class__.__name__, name)
         self.map = _map
         self.x = x
         self.y = y
 
+        # update every n-th tick
+        self.interval = 1
+
         self.map.sprites[self.id] = self
+        # sprites may be placed outside of small maps
+        if self.map.contains(x, y) and self.map.movable_layer[x][y] is None:
+            self.map.movable_layer[x][y] = self
+        self.map.wake(self)
 
     def kill(self):
         """Remove this sprite from the map."""
         del self.map.sprites[self.id]
+        self.map.active.pop(self.id, None)
+        if (self.map.contains(self.x, self.y) and
+                self.map.movable_layer[self.x][self.y] is self):
+            self.map.movable_layer[self.x][self.y] = None
 
     def step(self):
         """Update this sprite.
 
-        This function is executed once per mainloop cycle. Subclasses should
-        overwrite this in order to define custom behavior.
+        This function is executed once per mainloop cycle as long as the
+        sprite is awake. Subclasses should overwrite this in order to define
+        custom behavior.
 
         """
         pass
 
+    def is_idle(self):
+        """Check whether this sprite can be put to sleep.
+
+        Sleeping sprites are not stepped until they are woken up again, e.g.
+        by :py:meth:`Map.wake` or :py:meth:`Map.schedule`.
+
+        """
+        return True
+
     def interact(self, other):
         """Interact with this sprite.
 
@@ -232,36 +502,51 @@ class Sprite(object):
 class MovingSprite(Sprite):
     """A sprite that can move.
 
-    You can set :py:attr:`direction` to one of 'north', 'east', 'south', 'west'
-    or 'stop'.  This sprite will then automatically move one filed in the
+    You can set :py:attr:`direction` to one of :py:data:`NORTH`,
+    :py:data:`EAST`, :py:data:`SOUTH`, :py:data:`WEST` or :py:data:`STOP`.
+    The map will then automatically move this sprite one filed in the
     specified direction in every mainloop cycle.
 
     """
 
+    __slots__ = ('_direction',)
+
     def __init__(self, *args, **kwargs):
+        self._direction = STOP
         super(MovingSprite, self).__init__(*args, **kwargs)
-        self.direction = 'stop'
 
-    def step(self):
-        if self.direction == 'north':
-            self.map.move_sprite(self, 0, -1)
-        elif self.direction == 'east':
-            self.map.move_sprite(self, 1, 0)
-        elif self.direction == 'south':
-            self.map.move_sprite(self, 0, 1)
-        elif self.direction == 'west':
-            self.map.move_sprite(self, -1, 0)
+    @property
+    def direction(self):
+        return self._direction
+
+    @direction.setter
+    def direction(self, direction):
+        self._direction = direction
+        if direction != STOP:
+            self.map.wake(self)
+
+    def is_idle(self):
+        return self._direction == STOP
 
 
 class User(MovingSprite):
     """Sprite representing a user."""
 
+    __slots__ = ('seq',)
+
+    def __init__(self, *args, **kwargs):
+        super(User, self).__init__(*args, **kwargs)
+        self.seq = 0
+
 
 class Ghost(MovingSprite):
+    __slots__ = ()
+
+    def is_idle(self):
+        return False
+
     def step(self):
-        self.direction = random.choice(
-            ['north', 'east', 'south', 'west', 'stop'])
-        super(Ghost, self).step()
+        self.direction = self.map.random.randrange(len(DIRECTIONS))
 
 
 __all__ = ['MapManager', 'Map', 'Sprite', 'MovingSprite', 'User']
@@ -0,0 +1,153 @@
+"""Account for the memory used by the server.
+
+:py:class:`MemoryAccountant` attributes bytes to the parts of the server
+(maps, sprites, users and connections) by walking the objects that belong to
+them.  Every object is only counted once, for the first part that references
+it.  If :py:mod:`tracemalloc` is tracing, the report also contains the
+source lines that allocated the most memory.  Both are compared to the
+previous report for the same consumer to show growth.
+
+The numbers are estimates: :py:func:`sys.getsizeof` does not know about
+memory that is held outside of Python objects.  Taking a report blocks the
+mainloop for a moment, so it should not be done too often.
+
+"""
+
+import sys
+
+
+def sizeof(obj, seen=None):
+    """Size of ``obj`` including nested builtin containers.
+
+    Other objects that are referenced from containers are only counted
+    shallowly.  Objects whose id is in ``seen`` are skipped.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sizeof(key, seen) + sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += sizeof(item, seen)
+    return size
+
+
+def _add(totals, name, size):
+    totals[name] = totals.get(name, 0) + size
+
+
+def account(server):
+    """Attribute the memory of ``server`` to its parts.
+
+    Returns a dict with a dict of sizes per part and the number of orphaned
+    user sprites, i.e. users that are on a map but not logged in.
+    """
+    from .map import User
+
+    seen = set()
+    parts = {}
+    orphaned = 0
+
+    # sprites come first so they are not counted as part of the map layers
+    for _map in server.map_manager.store.values():
+        for sprite in _map.sprites.values():
+            size = sizeof(sprite, seen) + sizeof(sprite.id, seen)
+            _add(parts, 'sprites', size)
+
+            if isinstance(sprite, User):
+                name = sprite.id.split(':', 1)[1]
+                if server.users.get(name) is not sprite:
+                    orphaned += 1
+
+    _add(parts, 'users', sizeof(server.users, seen))
+    _add(parts, 'users', sizeof(server.saved_users, seen))
+    _add(parts, 'users', sizeof(server.map_users, seen))
+
+    for _map in server.map_manager.store.values():
+        _add(parts, 'maps.floor_layer', sizeof(_map.floor_layer, seen))
+        _add(parts, 'maps.movable_layer', sizeof(_map.movable_layer, seen))
+        _add(parts, 'maps.encoded', sizeof(_map._encoded, seen))
+        _add(parts, 'maps.other', (
+            sizeof(_map, seen) + sizeof(_map.sprites, seen) +
+            sizeof(_map.active, seen) + sizeof(_map._wakeups, seen)))
+
+    for connection in server.connections:
+        for name, size in connection.get_memory_usage().items():
+            _add(parts, 'connections.%s' % name, size)
+    _add(parts, 'connections.deferred', (
+        sizeof(server._deferred, seen) + sizeof(server._coalesced, seen)))
+
+    return {
+        'maps': len(server.map_manager.store),
+        'connections': len(server.connections),
+        'orphaned_sprites': orphaned,
+        'parts': parts,
+    }
+
+
+class MemoryAccountant(object):
+    def __init__(self, server):
+        self.server = server
+        # baselines per consumer, so e.g. an admin request does not reset
+        # the growth that is measured by the periodic reports
+        self.previous = {}
+        self.snapshots = {}
+
+    def start_tracing(self, frames=1):
+        """Start :py:mod:`tracemalloc`.  This slows down the server."""
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def _trace(self, limit, consumer):
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        if consumer not in self.snapshots:
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(self.snapshots[consumer], 'lineno')
+        self.snapshots[consumer] = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'current': current,
+            'peak': peak,
+            'top': [[
+                str(stat.traceback[0]),
+                stat.size,
+                getattr(stat, 'size_diff', stat.size),
+            ] for stat in stats[:limit]],
+        }
+
+    def report(self, limit=10, consumer='default'):
+        """Get a JSON serializable memory report.
+
+        ``growth`` contains the change of every part since the last report
+        for ``consumer``.
+        """
+        report = account(self.server)
+        parts = report['parts']
+        previous = self.previous.get(consumer, {})
+        report['total'] = sum(parts.values())
+        report['growth'] = {
+            name: size - previous.get(name, 0)
+            for name, size in parts.items()}
+        self.previous[consumer] = parts
+
+        # only imported when reports are taken; it is not needed at startup
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            report['tracemalloc'] = self._trace(limit, consumer)
+        return report
+
+
+__all__ = ['MemoryAccountant', 'account', 'sizeof']
@@ -0,0 +1,43 @@
+"""Pre-generate a region of the world on all cores.
+
+Example::
+
+    laneya-pregen --seed 42 --x=-5:5 --y=-5:5 --z=0:2
+
+"""
+
+import argparse
+import time
+
+from .map import MapManager
+
+
+def parse_range(s):
+    """Parse an inclusive range like ``-5:5``."""
+    if ':' in s:
+        start, end = s.rsplit(':', 1)
+        return range(int(start), int(end) + 1)
+    else:
+        return range(int(s), int(s) + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seed', default='0', help='world seed')
+    parser.add_argument('--x', type=parse_range, default='0')
+    parser.add_argument('--y', type=parse_range, default='0')
+    parser.add_argument('--z', type=parse_range, default='0')
+    parser.add_argument(
+        '--workers', type=int, help='number of processes (default: all cores)')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    map_manager = MapManager(None, 60, 40, seed=args.seed)
+    keys = [(X, Y, Z) for X in args.x for Y in args.y for Z in args.z]
+    count = map_manager.pregenerate(keys, workers=args.workers)
+    print('generated %i of %i maps in %.3fs' % (
+        count, len(keys), time.monotonic() - start))
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
@@ -62,65 +62,257 @@ Update
 """
 
 
+import os
+import sys
 import json
+import time
+import zlib
+import secrets
+import asyncio
+import inspect
 import logging
 
-try:
-    import asyncio
-except ImportError:
-    import trollius as asyncio
-
 from . import promise as q
+from . import memory
 from . import actions
 
 logger = logging.getLogger('laneya')
-logger.addHandler(logging.StreamHandler())
-logging.getLogger('trollius').addHandler(logging.StreamHandler())
 
 key = 0
 
+# duration of one server mainloop cycle in seconds
+TICK = 0.1
+
+# approximate state of zlib streams with the default parameters
+ZLIB_DEFLATE_STATE = (1 << 17) + (1 << 17)
+ZLIB_INFLATE_STATE = (1 << 15) + 7 * 1024
+
 
 class InvalidError(Exception):
     """The message is not valid, e.g. fields are missing."""
     pass
 
 
+class RawJSON(bytes):
+    """Response data that has already been encoded as JSON.
+
+    Request handlers can return this to avoid encoding the same data over
+    and over again.
+    """
+    pass
+
+
 class IllegalError(Exception):
     """The requested action does not comply with the rules."""
     pass
 
 
+class ResponseError(Exception):
+    """A request was not successful.
+
+    :py:attr:`response` is the rejected response or ``'timeout'``.
+    """
+
+    def __init__(self, response):
+        super(ResponseError, self).__init__(response)
+        self.response = response
+
+
 def generate_key():
     global key
     key += 1
     return key
 
 
+def get_loop_factory(name=None):
+    """Get a factory for the event loop implementation called ``name``.
+
+    ``name`` can be ``'asyncio'``, ``'uvloop'`` or ``'auto'``.  ``'auto'``
+    uses uvloop if it is installed.  The default is taken from the
+    ``LANEYA_LOOP`` environment variable and falls back to ``'auto'``.
+
+    """
+    if name is None:
+        name = os.environ.get('LANEYA_LOOP', 'auto')
+
+    if name in ['uvloop', 'auto']:
+        try:
+            import uvloop
+            return uvloop.new_event_loop
+        except ImportError:
+            if name == 'uvloop':
+                raise
+
+    if name in ['asyncio', 'auto']:
+        return asyncio.new_event_loop
+
+    raise ValueError('Unknown event loop: %s' % name)
+
+
+def run(main, loop=None):
+    """Run the coroutine ``main`` in a new event loop and close it after.
+
+    See :py:func:`get_loop_factory` for the possible values of ``loop``.
+    """
+    loop_factory = get_loop_factory(loop)
+
+    if hasattr(asyncio, 'Runner'):
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            return runner.run(main)
+    else:  # python < 3.11
+        return _run_legacy(main, loop_factory)
+
+
+def _cancel_all_tasks(loop):
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(
+        asyncio.gather(*tasks, return_exceptions=True))
+
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            loop.call_exception_handler({
+                'message': 'unhandled exception during shutdown',
+                'exception': task.exception(),
+                'task': task,
+            })
+
+
+def _run_legacy(main, loop_factory):
+    """Like :py:func:`asyncio.run`, but with a custom event loop.
+
+    Tasks that are still pending, e.g. ``main`` itself after a
+    :py:exc:`KeyboardInterrupt`, are cancelled so their cleanup code runs.
+    """
+    _loop = loop_factory()
+    asyncio.set_event_loop(_loop)
+    try:
+        return _loop.run_until_complete(main)
+    finally:
+        try:
+            _cancel_all_tasks(_loop)
+            _loop.run_until_complete(_loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            _loop.close()
+
+
 class LoopingCall(object):
+    """Call ``fn`` every ``interval`` seconds in a task.
+
+    Calls are scheduled relative to the start so they do not drift.
+    """
+
     def __init__(self, loop, fn, *args, **kwargs):
         self.loop = loop
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
-        self.running = False
+        self.task = None
         self.interval = None
 
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
     def start(self, interval, now=True):
         self.interval = interval
-        self.running = True
-
-        if now:
-            self._wrapped()
-        else:
-            self.loop.call_later(self.interval, self._wrapped)
+        self.task = self.loop.create_task(self._run(now))
 
     def stop(self):
-        self.running = False
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _run(self, now):
+        next_call = self.loop.time()
+        if not now:
+            next_call += self.interval
+
+        while True:
+            await asyncio.sleep(max(0, next_call - self.loop.time()))
+            next_call += self.interval
+            try:
+                self.fn(*self.args, **self.kwargs)
+            except Exception:
+                logger.exception('Error in looping call')
+
+
+class TokenBucket(object):
+    """Allow ``rate`` events per second with bursts of up to ``burst``."""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.last = clock()
+
+    def consume(self, n=1):
+        """Take ``n`` tokens if available and return whether that worked."""
+        now = self.clock()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+
+class ConnectionRegistry(object):
+    """Ordered set of connections with an index of the users they act for.
+
+    Adding and removing connections as well as looking up the connection of
+    a user are O(1).
+
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._users = {}
+
+    def __iter__(self):
+        return iter(self._connections)
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __contains__(self, connection):
+        return connection in self._connections
+
+    def add(self, connection):
+        self._connections[connection] = set()
+
+    def remove(self, connection):
+        """Remove a connection and return the users that were bound to it."""
+        users = self._connections.pop(connection)
+        for user in users:
+            del self._users[user]
+        return users
 
-    def _wrapped(self):
-        if self.running:
-            self.loop.call_later(self.interval, self._wrapped)
-            self.fn(*self.args, **self.kwargs)
+    def latest(self):
+        """Get the connection that was added last."""
+        return next(reversed(self._connections))
+
+    def bind(self, user, connection):
+        """Remember that ``user`` sends its requests over ``connection``."""
+        old = self._users.get(user)
+        if old is not connection:
+            if old is not None:
+                self._connections[old].discard(user)
+            self._users[user] = connection
+            self._connections[connection].add(user)
+
+    def unbind(self, user):
+        connection = self._users.pop(user, None)
+        if connection is not None:
+            self._connections[connection].discard(user)
+
+    def get(self, user):
+        """Get the connection of a user or ``None``."""
+        return self._users.get(user)
 
 
 class NetstringReceiver(asyncio.Protocol):
@@ -129,19 +321,93 @@ class NetstringReceiver(asyncio.Protocol):
     See http://cr.yp.to/proto/netstrings.txt for the specification of
     netstrings.
 
+    Writing is paused by the transport when its write buffer exceeds
+    :py:attr:`write_high` bytes and resumed once it drops below
+    :py:attr:`write_low` bytes.  While paused, :py:attr:`paused` is set.
+
+    Either direction of the stream can be compressed with a single zlib
+    context that is shared across frames.  The netstrings are simply written
+    into the compressed stream, so framing is not affected.  Compressed data
+    is only sent on :py:meth:`flush`.
+
     """
+
+    write_high = 64 * 1024
+    write_low = 16 * 1024
+
     def __init__(self):
         self.__buffer = b''
         self.transport = None
+        self.paused = False
+        self._compressor = None
+        self._decompressor = None
+        self.stats = {
+            'bytes_sent': 0,
+            'bytes_written': 0,
+            'bytes_received': 0,
+            'strings_sent': 0,
+            'strings_received': 0,
+            'pauses': 0,
+        }
 
     def connection_made(self, transport):
         self.transport = transport
+        transport.set_write_buffer_limits(
+            high=self.write_high, low=self.write_low)
+
+    def pause_writing(self):
+        self.paused = True
+        self.stats['pauses'] += 1
+
+    def resume_writing(self):
+        self.paused = False
 
     def string_received(self, data):
         raise NotImplementedError
 
+    def start_compression(self):
+        """Compress everything that is sent from now on."""
+        self._compressor = zlib.compressobj()
+
+    def start_decompression(self):
+        """Decompress everything that is received from now on.
+
+        This may be called from :py:meth:`string_received`.  Any data that
+        has already been received after that string is decompressed, too.
+        """
+        self._decompressor = zlib.decompressobj()
+        self.__buffer = self._decompressor.decompress(self.__buffer)
+
+    def flush(self):
+        """Send all data that is still held back by the compressor."""
+        if self._compressor is not None:
+            data = self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                self.stats['bytes_written'] += len(data)
+                self.transport.write(data)
+
+    def get_memory_usage(self):
+        """Estimate the bytes held by the buffers of this connection.
+
+        The state of zlib streams is estimated from the default window and
+        memory level as documented in zlib's ``zconf.h``.
+        """
+        output = 0
+        if self.transport is not None:
+            output = self.transport.get_write_buffer_size()
+        return {
+            'input_buffer': sys.getsizeof(self.__buffer),
+            'output_buffer': output,
+            'compression': (
+                (ZLIB_DEFLATE_STATE if self._compressor else 0) +
+                (ZLIB_INFLATE_STATE if self._decompressor else 0)),
+        }
+
     def data_received(self, data):
         # FIXME: invalid data should not crash the server
+        self.stats['bytes_received'] += len(data)
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
         self.__buffer += data
 
         while b':' in self.__buffer:
@@ -152,13 +418,23 @@ class NetstringReceiver(asyncio.Protocol):
                 assert remainder[length] == ord(b',')
                 s = remainder[:length]
                 self.__buffer = self.__buffer[len(b'%i:%s,' % (length, s)):]
+                self.stats['strings_received'] += 1
                 self.string_received(s)
             else:
                 break
 
     def send_string(self, data):
-        b = data.encode('utf8')
-        self.transport.write(b'%i:%s,' % (len(b), b))
+        self.send_bytes(data.encode('utf8'))
+
+    def send_bytes(self, b):
+        frame = b'%i:%s,' % (len(b), b)
+        self.stats['bytes_sent'] += len(frame)
+        self.stats['strings_sent'] += 1
+        if self._compressor is not None:
+            frame = self._compressor.compress(frame)
+        if frame:
+            self.stats['bytes_written'] += len(frame)
+            self.transport.write(frame)
 
 
 class JSONProtocol(NetstringReceiver):
@@ -175,56 +451,201 @@ class JSONProtocol(NetstringReceiver):
         return self.send_string(json.dumps(data))
 
 
+def validate_action(action, data):
+    try:
+        fn = getattr(actions, action)
+        fn(**data)
+    except Exception:
+        logger.error('Invalid action: %s %s', action, data)
+        raise InvalidError
+
+
 class BaseProtocol(JSONProtocol):
 
     def validate_message(self, message, expected_keys):
         if sorted(message.keys()) != expected_keys:
-            logger.error('Invalid message: %s' % message)
+            logger.error('Invalid message: %s', message)
             raise InvalidError
 
     def validate_action(self, action, data):
-        try:
-            fn = getattr(actions, action)
-            fn(**data)
-        except Exception:
-            logger.error('Invalid action: %s %s' % (action, data))
-            raise InvalidError
+        validate_action(action, data)
 
 
 class ServerProtocol(BaseProtocol):
-    """Default implementation of the server protocol."""
+    """Default implementation of the server protocol.
+
+    Slow clients are handled as follows:  While writing is paused,
+    ``positions`` updates are not written but merged so that only the latest
+    position of each entity is sent once writing is resumed.  If writing
+    stays paused for more than :py:attr:`max_paused` seconds or the write
+    buffer grows beyond :py:attr:`max_buffer` bytes, the client is
+    disconnected.
+
+    Every user may send :py:attr:`request_rate` requests per second with
+    bursts of up to :py:attr:`request_burst` requests.  The connection as a
+    whole is limited to :py:attr:`connection_rate` and
+    :py:attr:`connection_burst`, and it may only act for
+    :py:attr:`max_users` different users.  Requests above these limits are
+    answered with an "illegal" response without being processed.
+
+    """
+
+    max_buffer = 1024 * 1024
+    max_paused = 10
+
+    request_rate = 20
+    request_burst = 40
+    connection_rate = 50
+    connection_burst = 100
+    max_users = 8
+
+    compressions = ['zlib']
+
+    # larger ``positions`` updates are split into several datagrams to avoid
+    # IP fragmentation
+    max_datagram = 1200
+
+    # updates go over the stream again if the client has not sent a
+    # keepalive for this many seconds, e.g. because a NAT dropped the mapping
+    datagram_timeout = 10
 
     def __init__(self, factory):
         super(ServerProtocol, self).__init__()
         self.factory = factory
+        self.paused_since = None
+        self._pending_positions = {}
+        self._bucket = TokenBucket(self.connection_rate, self.connection_burst)
+        self._buckets = {}
+        self.datagram_addr = None
+        self.datagram_token = None
+        self.datagram_seen = None
+        # ``positions`` updates are numbered on both channels so clients can
+        # tell which one is the latest
+        self.update_seq = 0
+        self.stats['datagrams_sent'] = 0
+        self.stats['merged'] = 0
+        self.stats['rate_limited'] = 0
 
     def connection_made(self, transport):
         super(ServerProtocol, self).connection_made(transport)
-        self.factory.connections.append(self)
+        self.factory.connections.add(self)
 
     def connection_lost(self, reason):
-        self.factory.connections.remove(self)
+        users = self.factory.connections.remove(self)
+        self.factory.drop_datagram_token(self)
+        self.factory.connection_lost(self, users)
+
+    def pause_writing(self):
+        super(ServerProtocol, self).pause_writing()
+        self.paused_since = time.monotonic()
+
+    def resume_writing(self):
+        super(ServerProtocol, self).resume_writing()
+        self.paused_since = None
+
+        if self._pending_positions:
+            positions = list(self._pending_positions.values())
+            self._pending_positions = {}
+            self._send_update('positions', positions=positions)
+
+    def get_memory_usage(self):
+        usage = super(ServerProtocol, self).get_memory_usage()
+        usage['pending'] = (
+            memory.sizeof(self._pending_positions) +
+            memory.sizeof(self._buckets))
+        return usage
+
+    def _check_slow_consumer(self):
+        if self.transport.is_closing():
+            return False
+        elif (self.transport.get_write_buffer_size() > self.max_buffer or (
+                self.paused_since is not None and
+                time.monotonic() - self.paused_since > self.max_paused)):
+            logger.error('Disconnecting slow client')
+            self.stats['disconnected'] = 'slow'
+            self.transport.abort()
+            return False
+        return True
 
     def _request_received(self, key, user, action, **data):
+        self.factory.connections.bind(user, self)
+        if action == 'handshake':
+            self._handshake(key, **data)
+        elif action == 'datagram':
+            token = self.factory.create_datagram_token(self)
+            self._send_response(
+                key, 'success', token=token, port=self.factory.datagram_port)
+        elif action in self.factory.coalesced_actions:
+            self.factory.defer_request(self, key, user, action, data)
+        else:
+            if action in self.factory.superseding_actions:
+                self.factory.drop_deferred(user)
+            self._process_request(key, user, action, **data)
+
+    def _process_request(self, key, user, action, **data):
         try:
             response = self.factory.request_received(user, action, **data)
-        except InvalidError as err:
-            return self._send_response(key, 'invalid', message=str(err))
-        except IllegalError as err:
-            return self._send_response(key, 'illegal', message=str(err))
         except Exception as err:
-            logger.error(err)
-            return self._send_response(key, 'internal', message=str(err))
+            return self._send_error(key, err)
+
+        # request handlers may also be coroutines
+        if inspect.isawaitable(response):
+            task = asyncio.ensure_future(response)
+            task.add_done_callback(lambda t: self._request_done(key, t))
+        else:
+            self._send_success(key, response)
+
+    def _request_done(self, key, task):
+        if task.cancelled():
+            self._send_response(key, 'internal', message='cancelled')
+        elif task.exception() is not None:
+            self._send_error(key, task.exception())
+        else:
+            self._send_success(key, task.result())
 
+    def _send_success(self, key, response):
         if response is None:
             response = {}
 
+        if isinstance(response, RawJSON):
+            self.send_bytes(
+                b'{"type": "response", "key": %s, "status": "success", '
+                b'"data": %s}' % (json.dumps(key).encode('utf8'), response))
+            return self.flush()
+
         return self._send_response(key, 'success', **response)
 
+    def _send_error(self, key, err):
+        if isinstance(err, InvalidError):
+            return self._send_response(key, 'invalid', message=str(err))
+        elif isinstance(err, IllegalError):
+            return self._send_response(key, 'illegal', message=str(err))
+        else:
+            logger.error('Error processing request: %s', err, exc_info=err)
+            return self._send_response(key, 'internal', message=str(err))
+
     def json_received(self, message):
         if message['type'] == 'request':
             self.validate_message(
                 message, ['action', 'data', 'key', 'type', 'user'])
+
+            user = message['user']
+            error = None
+            if user not in self._buckets:
+                if len(self._buckets) >= self.max_users:
+                    error = 'too many users'
+                else:
+                    self._buckets[user] = TokenBucket(
+                        self.request_rate, self.request_burst)
+            if error is None and not (
+                    self._bucket.consume() and
+                    self._buckets[user].consume()):
+                error = 'rate limit exceeded'
+            if error is not None:
+                self.stats['rate_limited'] += 1
+                return self._send_response(
+                    message['key'], 'illegal', message=error)
+
             self.validate_action(message['action'], message['data'])
             self._request_received(
                 message['key'],
@@ -232,9 +653,22 @@ class ServerProtocol(BaseProtocol):
                 message['action'],
                 **message['data'])
         else:
-            logger.error('Message type not known: %s' % message['type'])
-
-    def _send_response(self, key, status, **kwargs):
+            logger.error('Message type not known: %s', message['type'])
+
+    def _handshake(self, key, compression=None):
+        if self._compressor is not None:
+            # the client would run a new decompressor over data that it has
+            # already decompressed
+            return self._send_response(
+                key, 'illegal', message='compression is already active')
+        if compression not in self.compressions:
+            compression = None
+        self._send_response(key, 'success', compression=compression)
+        if compression == 'zlib':
+            self.start_compression()
+
+    def _write_response(self, key, status, **kwargs):
+        """Like :py:meth:`_send_response`, but without flushing."""
         data = {
             'type': 'response',
             'key': key,
@@ -243,34 +677,267 @@ class ServerProtocol(BaseProtocol):
         }
         self.send_json(data)
 
+    def _send_response(self, key, status, **kwargs):
+        self._write_response(key, status, **kwargs)
+        # responses are not held back until the end of the tick
+        self.flush()
+
+    def _split_positions(self, positions):
+        """Split positions into chunks that fit into one datagram each."""
+        # leave room for the envelope
+        limit = self.max_datagram - 64
+        chunk = []
+        size = 0
+        for entry in positions:
+            entry_size = len(json.dumps(entry)) + 2
+            if chunk and size + entry_size > limit:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(entry)
+            size += entry_size
+        if chunk or not positions:
+            yield chunk
+
+    def _send_datagram(self, action, **kwargs):
+        """Send an update over the datagram channel if possible.
+
+        Returns whether that worked.
+        """
+        transport = self.factory.datagram_transport
+        if (action != 'positions' or self.datagram_addr is None or
+                transport is None or transport.is_closing()):
+            return False
+        if time.monotonic() - self.datagram_seen > self.datagram_timeout:
+            return False
+
+        for chunk in self._split_positions(kwargs['positions']):
+            self.update_seq += 1
+            payload = json.dumps([self.update_seq, action, {
+                'positions': chunk}])
+            transport.sendto(payload.encode('utf8'), self.datagram_addr)
+            self.stats['datagrams_sent'] += 1
+        return True
+
     def _send_update(self, action, **kwargs):
+        if not self._check_slow_consumer():
+            return
+
+        if self._send_datagram(action, **kwargs):
+            return
+
+        if self.paused and action == 'positions':
+            for entry in kwargs['positions']:
+                if entry[0] in self._pending_positions:
+                    self.stats['merged'] += 1
+                self._pending_positions[entry[0]] = entry
+            return
+
         data = {
             'type': 'update',
             'action': action,
             'data': kwargs,
         }
+        if action == 'positions':
+            self.update_seq += 1
+            data['seq'] = self.update_seq
         self.send_json(data)
 
 
+class DatagramServerProtocol(asyncio.DatagramProtocol):
+    """Unreliable side channel for high frequency updates.
+
+    The client authenticates its address by sending a token that it got in
+    response to a ``datagram`` request over its stream connection.  It keeps
+    sending the token as a keepalive.  As long as keepalives arrive,
+    ``positions`` updates are sent as datagrams of the form
+    ``[seq, action, data]`` instead of over the stream.  ``positions``
+    updates that are sent over the stream have the same ``seq``.  Clients
+    should ignore the position of an entity if they already got a position
+    for it with a higher ``seq`` on either channel.
+
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def connection_made(self, transport):
+        self.factory.datagram_transport = transport
+        self.factory.datagram_port = transport.get_extra_info('sockname')[1]
+
+    def datagram_received(self, data, addr):
+        try:
+            token = data.decode('ascii')
+        except UnicodeDecodeError:
+            return
+        self.factory.datagram_authenticated(token, addr)
+
+
+class DatagramClientProtocol(asyncio.DatagramProtocol):
+    """Client side of :py:class:`DatagramServerProtocol`."""
+
+    # must be well below :py:attr:`ServerProtocol.datagram_timeout`
+    keepalive_interval = 2
+
+    def __init__(self, factory, token):
+        self.factory = factory
+        self.token = token.encode('ascii')
+        self.transport = None
+        self.keepalive = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # datagrams may get lost
+        for i in range(3):
+            transport.sendto(self.token)
+
+    def connection_lost(self, exc):
+        if self.keepalive is not None:
+            self.keepalive.stop()
+
+    def start_keepalive(self, loop):
+        """Keep the NAT mapping for this channel alive."""
+        self.keepalive = LoopingCall(loop, self.send_keepalive)
+        self.keepalive.start(self.keepalive_interval, now=False)
+
+    def send_keepalive(self):
+        if not self.transport.is_closing():
+            self.transport.sendto(self.token)
+
+    def datagram_received(self, data, addr):
+        try:
+            seq, action, kwargs = json.loads(data.decode('utf8'))
+            validate_action(action, kwargs)
+        except (ValueError, InvalidError):
+            return
+        self.factory.positions_received(seq, kwargs['positions'])
+
+
 class ServerProtocolFactory(object):
-    """Factory for :py:class:`ServerProtocol`."""
+    """Factory for :py:class:`ServerProtocol`.
+
+    Requests for :py:attr:`coalesced_actions` are not processed right away.
+    Only the latest of these requests per user and action is processed when
+    :py:meth:`flush_requests` is called, which should happen once per
+    mainloop cycle.  All other requests are acknowledged at the same time
+    with responses that have ``coalesced`` set.  This only makes sense for
+    idempotent actions.
+
+    Requests for :py:attr:`superseding_actions` are processed right away and
+    drop the pending requests of the same user, which are acknowledged as
+    coalesced.  Otherwise e.g. a ``move`` would log the user in again after
+    a ``logout``.
+
+    """
+
+    coalesced_actions = ['move']
+    superseding_actions = ['logout']
 
     def __init__(self):
-        self.connections = []
+        self.connections = ConnectionRegistry()
+        self._deferred = {}
+        self._coalesced = {}
+        self.datagram_transport = None
+        self.datagram_port = None
+        self._datagram_tokens = {}
 
     def build_protocol(self):
         return ServerProtocol(self)
 
     def request_received(self, user, action, **kwargs):
-        """Overwrite this on the server implementation."""
+        """Overwrite this on the server implementation.
+
+        This may return the response data directly or a coroutine that
+        returns it.
+        """
         raise NotImplementedError
 
+    def defer_request(self, connection, key, user, action, data):
+        pending = self._deferred.pop((user, action), None)
+        if pending is not None:
+            old_connection, old_key, old_data = pending
+            self._coalesced.setdefault(old_connection, []).append(old_key)
+        # re-insert so requests are processed in the order of their latest
+        # occurrence
+        self._deferred[(user, action)] = (connection, key, data)
+
+    def drop_deferred(self, user):
+        """Drop the pending requests of ``user``."""
+        for action in self.coalesced_actions:
+            pending = self._deferred.pop((user, action), None)
+            if pending is not None:
+                connection, key, data = pending
+                self._coalesced.setdefault(connection, []).append(key)
+
+    def flush_requests(self):
+        """Process the latest deferred request per user and action."""
+        coalesced = self._coalesced
+        self._coalesced = {}
+        for connection, keys in coalesced.items():
+            if connection in self.connections:
+                for key in keys:
+                    connection._write_response(key, 'success', coalesced=True)
+                connection.flush()
+
+        deferred = self._deferred
+        self._deferred = {}
+        for (user, action), (connection, key, data) in deferred.items():
+            if connection in self.connections:
+                connection._process_request(key, user, action, **data)
+
+    def connection_lost(self, connection, users):
+        """Overwrite this on the server implementation.
+
+        ``users`` are the users that sent requests over ``connection``.
+        """
+        pass
+
     def broadcast_update(self, action, **kwargs):
         """Broadcast an update to all connected clients."""
 
-        for connection in self.connections:
+        for connection in list(self.connections):
             connection._send_update(action, **kwargs)
 
+    def build_datagram_protocol(self):
+        return DatagramServerProtocol(self)
+
+    def create_datagram_token(self, connection):
+        """Create a token that binds a datagram address to ``connection``.
+
+        The token replaces a previous one of the same connection.  It stays
+        valid until the connection is lost.
+        """
+        self.drop_datagram_token(connection)
+        token = secrets.token_hex(16)
+        self._datagram_tokens[token] = connection
+        connection.datagram_token = token
+        return token
+
+    def drop_datagram_token(self, connection):
+        self._datagram_tokens.pop(connection.datagram_token, None)
+        connection.datagram_token = None
+
+    def datagram_authenticated(self, token, addr):
+        connection = self._datagram_tokens.get(token)
+        if connection is not None and connection in self.connections:
+            connection.datagram_addr = addr
+            connection.datagram_seen = time.monotonic()
+
+    def broadcast_datagram(self, action, **kwargs):
+        """Send an update to all clients that have a datagram channel."""
+        for connection in list(self.connections):
+            if connection.datagram_addr is not None:
+                connection._send_datagram(action, **kwargs)
+
+    def flush_connections(self):
+        """Flush all connections.  Call this once per mainloop cycle."""
+        for connection in self.connections:
+            connection.flush()
+
+    def get_stats(self):
+        """Get the statistics of all connections."""
+        return [connection.stats for connection in self.connections]
+
 
 class ClientProtocol(BaseProtocol):
     """Default implementation of the client protocol."""
@@ -279,10 +946,15 @@ class ClientProtocol(BaseProtocol):
         super(ClientProtocol, self).__init__()
         self.factory = factory
         self._response_promises = {}
+        # keys of handshake requests, which are tracked independently of
+        # their promises because those may time out
+        self._handshakes = set()
 
     def connection_made(self, transport):
         super(ClientProtocol, self).connection_made(transport)
-        self.factory.connections.append(self)
+        # update sequence numbers start over with every connection
+        self.factory._position_seqs = {}
+        self.factory.connections.add(self)
         self.factory.connection_made()
 
     def connection_lost(self, reason):
@@ -292,6 +964,13 @@ class ClientProtocol(BaseProtocol):
         if message['type'] == 'response':
             self.validate_message(message, ['data', 'key', 'status', 'type'])
             key = message['key']
+            if key in self._handshakes:
+                self._handshakes.discard(key)
+                # the server compresses everything after this response, no
+                # matter whether we are still waiting for it
+                if (message['status'] == 'success' and
+                        message['data'].get('compression') == 'zlib'):
+                    self.start_decompression()
             if key in self._response_promises:
                 response = {
                     'status': message['status'],
@@ -304,12 +983,19 @@ class ClientProtocol(BaseProtocol):
                     promise.reject(response)
 
         elif message['type'] == 'update':
-            self.validate_message(message, ['action', 'data', 'type'])
-            self.validate_action(message['action'], message['data'])
-            self.update_received(message['action'], **message['data'])
+            if message.get('action') == 'positions':
+                self.validate_message(
+                    message, ['action', 'data', 'seq', 'type'])
+                self.validate_action(message['action'], message['data'])
+                self.factory.positions_received(
+                    message['seq'], message['data']['positions'])
+            else:
+                self.validate_message(message, ['action', 'data', 'type'])
+                self.validate_action(message['action'], message['data'])
+                self.update_received(message['action'], **message['data'])
 
         else:
-            logger.error('Message type not known: %s' % message['type'])
+            logger.error('Message type not known: %s', message['type'])
 
     def update_received(self, action, **kwargs):
         self.factory.update_received(action, **kwargs)
@@ -330,12 +1016,40 @@ class ClientProtocol(BaseProtocol):
             'data': kwargs,
         }
         self.send_json(data)
+        if action == 'handshake':
+            self._handshakes.add(data['key'])
 
         promise = q.Promise()
         self._response_promises[data['key']] = promise
         self.factory.loop.call_later(2, self._timeout, promise, data['key'])
         return promise
 
+    def handshake(self, compression='zlib'):
+        """Negotiate connection options with the server.
+
+        Currently, the only option is whether updates and responses from the
+        server should be compressed.
+        """
+        return self.send_request('handshake', compression=compression)
+
+    async def send_request_async(self, action, **kwargs):
+        """Send a request and wait for the response.
+
+        Raises :py:exc:`ResponseError` if the request was not successful.
+        """
+        future = self.factory.loop.create_future()
+
+        def resolve(response):
+            if not future.done():
+                future.set_result(response)
+
+        def reject(response):
+            if not future.done():
+                future.set_exception(ResponseError(response))
+
+        self.send_request(action, **kwargs).then(resolve, reject)
+        return await future
+
 
 class ClientProtocolFactory(object):
     """Factory for :py:class:`ClientProtocol`.
@@ -345,7 +1059,8 @@ class ClientProtocolFactory(object):
 
     def __init__(self, loop):
         self.loop = loop
-        self.connections = []
+        self.connections = ConnectionRegistry()
+        self._position_seqs = {}
 
     def build_protocol(self):
         return ClientProtocol(self)
@@ -356,7 +1071,41 @@ class ClientProtocolFactory(object):
 
     def send_request(self, action, **kwargs):
         """Send a request and get a promise yielding the response."""
-        return self.connections[-1].send_request(action, **kwargs)
+        return self.connections.latest().send_request(action, **kwargs)
+
+    async def send_request_async(self, action, **kwargs):
+        """Send a request and wait for the response."""
+        connection = self.connections.latest()
+        return await connection.send_request_async(action, **kwargs)
+
+    def handshake(self, compression='zlib'):
+        return self.connections.latest().handshake(compression)
+
+    async def open_datagram_channel(self, host):
+        """Receive ``positions`` updates over an unreliable side channel."""
+        response = await self.send_request_async('datagram')
+        data = response['data']
+        transport, protocol = await self.loop.create_datagram_endpoint(
+            lambda: DatagramClientProtocol(self, data['token']),
+            remote_addr=(host, data['port']))
+        protocol.start_keepalive(self.loop)
+        return protocol
+
+    def positions_received(self, seq, positions):
+        """Pass on the positions that are newer than the ones we have.
+
+        ``positions`` updates arrive over the stream and the datagram
+        channel, and datagrams may be reordered.  Only the entries with a
+        higher ``seq`` than the last one for the same entity are passed to
+        :py:meth:`update_received`.
+        """
+        fresh = []
+        for entry in positions:
+            if self._position_seqs.get(entry[0], 0) < seq:
+                self._position_seqs[entry[0]] = seq
+                fresh.append(entry)
+        if fresh:
+            self.update_received('positions', positions=fresh)
 
     def update_received(self, action, **kwargs):
         """Overwrite this on the client implementation."""
@@ -369,9 +1118,18 @@ class ClientProtocolFactory(object):
 
 __all__ = [
     'InvalidError',
+    'ConnectionRegistry',
+    'TokenBucket',
     'IllegalError',
+    'RawJSON',
+    'ResponseError',
+    'LoopingCall',
+    'get_loop_factory',
+    'run',
     'ServerProtocol',
     'ServerProtocolFactory',
+    'DatagramServerProtocol',
+    'DatagramClientProtocol',
     'ClientProtocol',
     'ClientProtocolFactory',
 ]
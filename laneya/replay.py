@@ -0,0 +1,148 @@
+"""Record requests and replay them deterministically.
+
+``laneyad --record FILE`` appends every request that the server processes
+to a compact binary log, tagged with the number of the tick after which it
+was processed.  Users that are logged out because their connection was lost
+are recorded, too.  When the server stops, a digest of the final state is
+appended as well.
+
+A recording server generates all maps from its seed, just like the replay.
+It does not use the world store, the snapshot or the list of hot maps, so
+its state only depends on the recorded requests.
+
+``laneya-replay FILE`` feeds such a log into a headless server as fast as
+possible, checks that the final state is identical and reports the
+throughput.  This turns real sessions into repeatable benchmarks.
+
+The log format is::
+
+    header:  magic (4 bytes), version (unsigned short),
+             seed length (unsigned short), seed (utf8)
+    record:  type (unsigned char), tick (uint), length (uint), payload
+
+A request record contains ``[user, action, data]`` as JSON.  A disconnect
+record contains the list of users that were bound to the lost connection as
+JSON.  The final record contains the state digest.
+
+"""
+
+import json
+import time
+import struct
+import argparse
+
+MAGIC = b'LNYR'
+VERSION = 2
+
+HEADER = struct.Struct('<4sHH')
+RECORD = struct.Struct('<BII')
+
+REQUEST = 0
+END = 1
+DISCONNECT = 2
+
+
+class Recorder(object):
+    def __init__(self, filename, seed):
+        self.fh = open(filename, 'wb')
+        seed = str(seed).encode('utf8')
+        self.fh.write(HEADER.pack(MAGIC, VERSION, len(seed)) + seed)
+
+    def _write(self, record_type, tick, payload):
+        self.fh.write(RECORD.pack(record_type, tick, len(payload)) + payload)
+
+    def record(self, tick, user, action, data):
+        payload = json.dumps([user, action, data], separators=(',', ':'))
+        self._write(REQUEST, tick, payload.encode('utf8'))
+
+    def record_disconnect(self, tick, users):
+        payload = json.dumps(sorted(users), separators=(',', ':'))
+        self._write(DISCONNECT, tick, payload.encode('utf8'))
+
+    def close(self, server):
+        """Write the final state of ``server`` and close the log."""
+        digest = server.get_state_digest().encode('ascii')
+        self._write(END, server.tick, digest)
+        self.fh.close()
+
+
+def read(filename):
+    """Return the seed and a list of ``(type, tick, payload)`` records."""
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+
+    magic, version, length = HEADER.unpack_from(data, 0)
+    # version 1 only lacks disconnect records
+    if magic != MAGIC or version not in [1, VERSION]:
+        raise ValueError('Not a replay log: %s' % filename)
+    offset = HEADER.size
+    seed = data[offset:offset + length].decode('utf8')
+    offset += length
+
+    records = []
+    while offset + RECORD.size <= len(data):
+        record_type, tick, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        records.append((record_type, tick, data[offset:offset + length]))
+        offset += length
+
+    return seed, records
+
+
+def replay(filename):
+    """Replay a log in a headless server.
+
+    Returns the server, the expected state digest (or ``None`` if the log
+    was not closed properly) and the number of replayed requests.
+
+    """
+    from . import protocol
+    from .server import Server
+
+    seed, records = read(filename)
+    server = Server(seed=seed, persist=False)
+    expected = None
+    count = 0
+
+    for record_type, tick, payload in records:
+        while server.tick < tick:
+            server.mainloop()
+
+        if record_type == REQUEST:
+            user, action, data = json.loads(payload.decode('utf8'))
+            try:
+                server.request_received(user, action, **data)
+            except (protocol.InvalidError, protocol.IllegalError):
+                pass
+            count += 1
+        elif record_type == DISCONNECT:
+            server.connection_lost(None, json.loads(payload.decode('utf8')))
+        elif record_type == END:
+            expected = payload.decode('ascii')
+
+    return server, expected, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded session.')
+    parser.add_argument('log')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    server, expected, count = replay(args.log)
+    duration = time.monotonic() - start
+
+    print('replayed %i requests in %i ticks in %.3fs (%.1f ticks/s)' % (
+        count, server.tick, duration, server.tick / max(duration, 1e-9)))
+
+    if expected is None:
+        print('log has no final state; could not verify')
+    elif server.get_state_digest() == expected:
+        print('final state is identical')
+    else:
+        print('final state differs')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
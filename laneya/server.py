@@ -1,58 +1,348 @@
+import os
+import time
+import secrets
+import hashlib
+import asyncio
+import logging
+import argparse
+
 from . import protocol
-from .protocol import asyncio
-from .map import MapManager, User
+from . import snapshot
+from .log import setup_logging
+from .memory import MemoryAccountant
+from .map import MapManager, User, DIRECTION_CODES
+
+
+SNAPSHOT = 'maps/snapshot'
+SNAPSHOT_INTERVAL = 60
+
+# datagrams can get lost, so the positions of all sprites on active maps are
+# sent over the datagram channel every n ticks
+KEYFRAME_INTERVAL = 10
+
+logger = logging.getLogger('laneya.server')
 
 
 class Server(protocol.ServerProtocolFactory):
-    def __init__(self):
+    def __init__(self, seed=0, persist=True):
         super(Server, self).__init__()
+        self.tick = 0
         self.users = {}
-        self.map_manager = MapManager(self, 60, 40)
+        self.saved_users = {}
+        self.map_users = {}
+        self.publisher = None
+        self.recorder = None
+        # secret that admins send along with admin requests
+        self.admin_token = None
+        self.memory = MemoryAccountant(self)
+        # whether warm_up has finished
+        self.ready = False
+        self.map_manager = MapManager(
+            self, 60, 40, persist=persist, seed=seed)
 
     def request_received(self, user, action, **kwargs):  # TODO
+        # admin actions do not touch the game state, so they are neither
+        # recorded nor do they log in the user
+        if action == 'memory':
+            # the user name is chosen by the client, so it cannot be used
+            # to authorize admins
+            token = kwargs.get('token')
+            if self.admin_token is None or token is None or \
+                    not secrets.compare_digest(
+                        token.encode('utf8'),
+                        self.admin_token.encode('utf8')):
+                raise protocol.IllegalError('Only admins may do this')
+            return self.memory.report(consumer='admin')
+
+        if self.recorder is not None:
+            self.recorder.record(self.tick, user, action, kwargs)
+
         if user not in self.users:
-            initial_map = self.map_manager.get(0, 0, 0)
-            self.users[user] = User(user, initial_map, 10, 10)
-            print('login %s' % user)
+            self.login(user)
 
         if action == 'move':
-            self.users[user].direction = kwargs['direction']
+            sprite = self.users[user]
+            sprite.direction = DIRECTION_CODES[kwargs['direction']]
+            if kwargs.get('seq') is not None:
+                sprite.seq = kwargs['seq']
+            return {
+                'x': sprite.x,
+                'y': sprite.y,
+                'direction': kwargs['direction'],
+                'seq': sprite.seq,
+            }
         elif action == 'logout':
-            self.users[user].kill()
-            del self.users[user]
-            print('logout %s' % user)
+            self.logout(user)
         elif action == 'get_map':
-            return self.users[user].map.encode()
+            _map = self.users[user].map
+            if kwargs.get('key') is not None:
+                key = tuple(kwargs['key'])
+                if sum(abs(a - b) for a, b in zip(key, _map.key)) > 1:
+                    raise protocol.IllegalError('Map is not adjacent')
+                # prefetching must neither generate maps nor keep them
+                # loaded
+                _map = self.map_manager.peek(*key)
+                if _map is None:
+                    raise protocol.IllegalError('Map is not available')
+            if kwargs.get('version') == _map.version:
+                response = _map.get_info()
+                response['not_modified'] = True
+                return response
+            return protocol.RawJSON(_map.encode_json())
         else:
             raise protocol.InvalidError
 
+    def login(self, user):
+        key, x, y = self.saved_users.pop(user, ((0, 0, 0), 10, 10))
+        initial_map = self.map_manager.get(*key)
+        self.users[user] = User(user, initial_map, x, y)
+        self._add_to_map(initial_map)
+        logger.info('login %s', user, extra={
+            'category': 'login', 'data': {'user': user, 'map': key}})
+
+    def logout(self, user):
+        sprite = self.users.pop(user)
+        sprite.kill()
+        self._remove_from_map(sprite.map)
+        self.connections.unbind(user)
+        logger.info('logout %s', user, extra={
+            'category': 'logout', 'data': {'user': user}})
+
+    def connection_lost(self, connection, users):
+        if self.recorder is not None and users:
+            self.recorder.record_disconnect(self.tick, users)
+        for user in users:
+            if user in self.users:
+                self.logout(user)
+
+    def move_user(self, user, _map, x, y):
+        """Move a user to another map."""
+        sprite = self.users[user]
+        sprite.kill()
+        self._remove_from_map(sprite.map)
+        self.users[user] = User(user, _map, x, y)
+        self._add_to_map(_map)
+
+    def _add_to_map(self, _map):
+        self.map_users[_map] = self.map_users.get(_map, 0) + 1
+
+    def _remove_from_map(self, _map):
+        self.map_users[_map] -= 1
+        if self.map_users[_map] == 0:
+            del self.map_users[_map]
+
+    def warm_up(self, loop, restored=()):
+        """Load the start map and all maps that were active before.
+
+        ``restored`` are the maps of a snapshot as returned by
+        :py:func:`snapshot.read`.  Their sprites are restored, too.
+
+        One map is loaded per loop iteration so that connections can be
+        accepted in the meantime.  :py:attr:`ready` is set when all maps
+        have been loaded.
+
+        """
+        queue = list(restored)
+        keys = [key for key, tick, sprites in queue]
+        for key in [(0, 0, 0)] + self.map_manager.load_hot():
+            if key not in keys:
+                keys.append(key)
+                queue.append((key, None, None))
+        start = time.monotonic()
+
+        def load_next():
+            if queue:
+                key, tick, sprites = queue.pop(0)
+                if sprites is None:
+                    self.map_manager.get(*key)
+                else:
+                    snapshot.restore_map(self, key, tick, sprites)
+                loop.call_soon(load_next)
+            else:
+                self.ready = True
+                logger.info(
+                    'restored %i maps in %.3fs',
+                    len(self.map_manager.store), time.monotonic() - start)
+
+        loop.call_soon(load_next)
+
     def mainloop(self):
+        self.flush_requests()
+        self.tick += 1
+
         # only the maps with users in them get updated
-        for _map in self.get_active_maps():
+        for _map in self.get_dirty_maps():
             _map.step()
+            if self.publisher is not None:
+                try:
+                    self.publisher.publish(_map)
+                except Exception:
+                    # publishing is optional; never let it stop the tick
+                    logger.exception('Could not publish map %s', _map.key)
+
+        if self.tick % KEYFRAME_INTERVAL == 0:
+            for _map in self.get_active_maps():
+                self.broadcast_datagram('positions', positions=[
+                    [sprite.id, sprite.x, sprite.y, sprite.seq]
+                    for sprite in _map.sprites.values()])
+
+        self.flush_connections()
 
     def get_active_maps(self):
-        return set(user.map for user in self.users.values())
+        """Get all maps that contain at least one user."""
+        return list(self.map_users)
 
+    def get_dirty_maps(self):
+        """Get all active maps that have something to simulate."""
+        return [_map for _map in self.map_users if _map.dirty]
 
-def main():
-    loop = asyncio.get_event_loop()
+    def get_user_count(self, _map):
+        """Get the number of users on a map."""
+        return self.map_users.get(_map, 0)
+
+    def log_memory(self):
+        report = self.memory.report(consumer='periodic')
+        logger.info(
+            'memory: %i bytes in %i maps and %i connections, '
+            '%i orphaned sprites',
+            report['total'], report['maps'], report['connections'],
+            report['orphaned_sprites'],
+            extra={'category': 'memory', 'data': {'memory': report}})
+
+    def get_state_digest(self):
+        """Get a digest of the position of all sprites on all maps."""
+        h = hashlib.sha1(b'%i' % self.tick)
+        for key, _map in sorted(self.map_manager.store.items()):
+            for sprite_id, sprite in sorted(_map.sprites.items()):
+                h.update(('%i:%i:%i %s %i %i\n' % (
+                    key + (sprite_id, sprite.x, sprite.y))).encode('utf8'))
+        return h.hexdigest()
+
+
+async def serve(
+        host='localhost', port=5001, seed=0, shm=False, record=None,
+        admin_token=None, memory_interval=None, trace_memory=False):
+    start = time.monotonic()
+    loop = asyncio.get_running_loop()
+
+    # a recording must start from the generated world to be replayable, so
+    # the world store, the snapshot and the hot maps are not used
+    server = Server(seed=seed, persist=not record)
+    server.admin_token = admin_token
+    if not record:
+        # fail early if the world store belongs to a different seed
+        server.map_manager.world
+    if trace_memory:
+        server.memory.start_tracing()
+
+    if shm:
+        from .shm import MapPublisher
+        server.publisher = MapPublisher()
+
+    restored = []
+    if record:
+        from .replay import Recorder
+        server.recorder = Recorder(record, server.map_manager.seed)
+    elif os.path.exists(SNAPSHOT):
+        # the maps themselves are restored in the background by warm_up
+        restored = snapshot.read(SNAPSHOT)
+        snapshot.restore_users(server, restored)
 
-    server = Server()
-    coro = loop.create_server(server.build_protocol, 'localhost', 5001)
-    s = loop.run_until_complete(coro)
+    s = await loop.create_server(server.build_protocol, host, port)
+    datagram_transport, _ = await loop.create_datagram_endpoint(
+        server.build_datagram_protocol, local_addr=(host, port))
+
+    if not record:
+        server.warm_up(loop, restored)
 
     mainloop = protocol.LoopingCall(loop, server.mainloop)
-    mainloop.start(0.1)
+    mainloop.start(protocol.TICK)
+
+    def checkpoint():
+        # a snapshot of a partly restored state would lose sprites
+        if server.ready:
+            snapshotter.checkpoint()
+
+    snapshotter = snapshot.Snapshotter(server, SNAPSHOT)
+    checkpoints = protocol.LoopingCall(loop, checkpoint)
+    if not record:
+        checkpoints.start(SNAPSHOT_INTERVAL, now=False)
 
-    print('laneyad started on port localhost:5001')
+    memory_dumps = protocol.LoopingCall(loop, server.log_memory)
+    if memory_interval:
+        memory_dumps.start(memory_interval, now=False)
+
+    logger.info(
+        'laneyad started on port %s:%i in %.3fs',
+        host, port, time.monotonic() - start)
 
     try:
-        loop.run_forever()
+        await s.serve_forever()
     finally:
+        mainloop.stop()
+        checkpoints.stop()
+        memory_dumps.stop()
+        if server.ready:
+            server.map_manager.dump_hot(server.get_active_maps())
+            snapshotter.close()
+            try:
+                snapshotter.checkpoint(fork=False)
+            except Exception:
+                # still close everything else
+                logger.exception('Could not write the final snapshot')
+        if server.publisher is not None:
+            server.publisher.close()
+        if server.recorder is not None:
+            server.recorder.close(server)
+        datagram_transport.close()
         s.close()
-        loop.run_until_complete(s.wait_closed())
-        loop.close()
+        await s.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--loop', choices=['auto', 'asyncio', 'uvloop'],
+        help='event loop implementation (default: $LANEYA_LOOP or auto)')
+    parser.add_argument(
+        '--seed', default='0',
+        help='world seed; must match the seed of an existing world store')
+    parser.add_argument(
+        '--shm', action='store_true',
+        help='publish active maps to shared memory (see laneya.shm)')
+    parser.add_argument(
+        '--record', metavar='FILE',
+        help='record all requests for laneya-replay')
+    parser.add_argument(
+        '--log-json', action='store_true',
+        help='write log records as JSON objects, one per line')
+    parser.add_argument(
+        '--admin-token', metavar='TOKEN',
+        default=os.environ.get('LANEYA_ADMIN_TOKEN'),
+        help='secret that allows admin requests like memory '
+        '(default: $LANEYA_ADMIN_TOKEN)')
+    parser.add_argument(
+        '--memory-interval', type=float, metavar='SECONDS',
+        help='log a memory report every SECONDS')
+    parser.add_argument(
+        '--trace-memory', action='store_true',
+        help='include tracemalloc statistics in memory reports (slow)')
+    args = parser.parse_args()
+
+    listener = setup_logging(structured=args.log_json)
+    try:
+        protocol.run(serve(
+            seed=args.seed,
+            shm=args.shm,
+            record=args.record,
+            admin_token=args.admin_token,
+            memory_interval=args.memory_interval,
+            trace_memory=args.trace_memory,
+        ), loop=args.loop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
 
 
 if __name__ == '__main__':  # pragma: nocover
@@ -0,0 +1,153 @@
+"""Publish live map state to shared memory for local read-only tools.
+
+Tools like minimap renderers or spectator views can read the state of
+active maps without going through the network protocol and without putting
+any load on the game loop.  Every published map gets its own
+:py:class:`multiprocessing.shared_memory.SharedMemory` segment called
+``laneya_X_Y_Z`` with the following layout::
+
+    header:   seq (uint64), width, height (ushort), sprite count (uint)
+    tiles:    width * height tile codes (see :py:mod:`laneya.store`)
+    sprites:  CAPACITY times x, y (short), id (32 bytes utf8, zero padded)
+
+``seq`` is a seqlock:  It is odd while the server is writing.  Readers must
+retry if it is odd or changed while they were reading.
+
+"""
+
+import struct
+from multiprocessing import shared_memory
+
+from .store import encode_tiles
+
+HEADER = struct.Struct('<QHHI')
+SEQ = struct.Struct('<Q')
+SPRITE = struct.Struct('<hh32s')
+
+CAPACITY = 256
+
+
+def get_name(key):
+    return 'laneya_%i_%i_%i' % key
+
+
+def encode_id(sprite_id, size=32):
+    """Encode a sprite id to at most ``size`` bytes of utf8.
+
+    Longer ids are cut on a character boundary.
+    """
+    b = sprite_id.encode('utf8')
+    if len(b) > size:
+        b = b[:size].decode('utf8', 'ignore').encode('utf8')
+    return b
+
+
+class MapPublisher(object):
+    """Write the state of maps to shared memory segments.
+
+    Only the first :py:data:`CAPACITY` sprites of a map are published.
+    """
+
+    def __init__(self):
+        self.segments = {}
+
+    def _create(self, _map):
+        tile_size = _map.width * _map.height
+        size = HEADER.size + tile_size + CAPACITY * SPRITE.size
+        name = get_name(_map.key)
+        try:
+            segment = shared_memory.SharedMemory(
+                name=name, create=True, size=size)
+        except FileExistsError:
+            # left over from a server that crashed; readers that are still
+            # attached keep their copy
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            segment = shared_memory.SharedMemory(
+                name=name, create=True, size=size)
+
+        HEADER.pack_into(segment.buf, 0, 0, _map.width, _map.height, 0)
+        segment.buf[HEADER.size:HEADER.size + tile_size] = \
+            encode_tiles(_map.floor_layer)
+        return segment
+
+    def publish(self, _map):
+        if _map.key not in self.segments:
+            self.segments[_map.key] = self._create(_map)
+        segment = self.segments[_map.key]
+        buf = segment.buf
+
+        seq = SEQ.unpack_from(buf, 0)[0]
+        SEQ.pack_into(buf, 0, seq + 1)
+
+        offset = HEADER.size + _map.width * _map.height
+        count = 0
+        for sprite in _map.sprites.values():
+            if count == CAPACITY:
+                break
+            SPRITE.pack_into(
+                buf, offset, sprite.x, sprite.y, encode_id(sprite.id))
+            offset += SPRITE.size
+            count += 1
+
+        HEADER.pack_into(buf, 0, seq + 1, _map.width, _map.height, count)
+        SEQ.pack_into(buf, 0, seq + 2)
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+            segment.unlink()
+        self.segments = {}
+
+
+class MapReader(object):
+    """Read a map that is published by :py:class:`MapPublisher`."""
+
+    def __init__(self, key):
+        try:
+            self.segment = shared_memory.SharedMemory(
+                name=get_name(key), track=False)
+        except TypeError:  # python < 3.13
+            from multiprocessing import resource_tracker
+            self.segment = shared_memory.SharedMemory(name=get_name(key))
+            # readers must not remove the segment when they exit
+            resource_tracker.unregister(
+                self.segment._name, 'shared_memory')
+
+        _, self.width, self.height, _ = HEADER.unpack_from(self.segment.buf)
+
+    @property
+    def tiles(self):
+        """Memoryview of the tile codes.  Tiles do not change."""
+        start = HEADER.size
+        return self.segment.buf[start:start + self.width * self.height]
+
+    def read(self):
+        """Get a consistent ``(seq, sprites)`` tuple.
+
+        ``sprites`` is a list of ``(id, x, y)`` tuples.
+        """
+        buf = self.segment.buf
+        offset = HEADER.size + self.width * self.height
+
+        while True:
+            seq, _, _, count = HEADER.unpack_from(buf, 0)
+            if seq % 2:
+                continue
+
+            sprites = []
+            for i in range(count):
+                x, y, sprite_id = SPRITE.unpack_from(
+                    buf, offset + i * SPRITE.size)
+                sprites.append((
+                    sprite_id.rstrip(b'\0').decode('utf8'), x, y))
+
+            if SEQ.unpack_from(buf, 0)[0] == seq:
+                return seq, sprites
+
+    def close(self):
+        self.segment.close()
+
+
+__all__ = ['MapPublisher', 'MapReader']
@@ -0,0 +1,230 @@
+"""Snapshots of the live simulation state.
+
+The floor of every map is persisted in the :py:mod:`laneya.store`.  This
+module takes care of everything else that only exists in memory: the sprites
+on all loaded maps and the users.
+
+A snapshot is a compact binary file::
+
+    header:  magic (4 bytes), version (unsigned short), map count (uint)
+    map:     X, Y, Z (signed ints), tick, sprite count (uints)
+    sprite:  class, direction, interval (unsigned chars), x, y (shorts),
+             seq (uint), id length (unsigned short), id (utf8)
+
+Snapshots are written by a forked child process if possible.  The child gets
+a copy-on-write view of the server's memory, so the mainloop does not have to
+wait for serialisation or disk I/O.  Where :py:func:`os.fork` is not available
+the snapshot is written synchronously.
+
+Users are not connected when a snapshot is restored.  Their sprites are
+therefore not placed on the map right away but remembered in
+:py:attr:`Server.saved_users` until they log in again.
+
+The server restores a snapshot in steps so it can accept connections in the
+meantime:  The users are restored right after :py:func:`read`.  The maps are
+then restored one by one with :py:func:`restore_map` (see
+:py:meth:`Server.warm_up`).
+
+"""
+
+import os
+import struct
+import logging
+
+from .map import Sprite, MovingSprite, User, Ghost
+
+MAGIC = b'LNYS'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHI')
+MAP = struct.Struct('<iiiII')
+SPRITE = struct.Struct('<BBBhhIH')
+
+SPRITE_CLASSES = [Sprite, MovingSprite, User, Ghost]
+
+logger = logging.getLogger('laneya.snapshot')
+
+
+def _encode_sprite(cls, sprite_id, x, y, direction=0, interval=1, seq=0):
+    b = sprite_id.encode('utf8')
+    return SPRITE.pack(
+        SPRITE_CLASSES.index(cls), direction, interval, x, y, seq, len(b)) + b
+
+
+def encode(server):
+    """Serialize the state of all loaded maps and users."""
+    maps = {}
+    for key, _map in server.map_manager.store.items():
+        maps[key] = (_map.tick, [_encode_sprite(
+            type(sprite), sprite.id, sprite.x, sprite.y,
+            sprite.direction, sprite.interval, sprite.seq,
+        ) for sprite in _map.sprites.values()])
+
+    for name, (key, x, y) in server.saved_users.items():
+        if key not in maps:
+            maps[key] = (0, [])
+        maps[key][1].append(_encode_sprite(User, 'User:%s' % name, x, y))
+
+    chunks = [HEADER.pack(MAGIC, VERSION, len(maps))]
+    for (X, Y, Z), (tick, sprites) in maps.items():
+        chunks.append(MAP.pack(X, Y, Z, tick, len(sprites)))
+        chunks.extend(sprites)
+    return b''.join(chunks)
+
+
+def decode(data):
+    """Yield ``(key, tick, sprites)`` for every map in a snapshot."""
+    magic, version, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a snapshot')
+    offset = HEADER.size
+
+    for i in range(count):
+        X, Y, Z, tick, sprite_count = MAP.unpack_from(data, offset)
+        offset += MAP.size
+
+        sprites = []
+        for j in range(sprite_count):
+            code, direction, interval, x, y, seq, length = \
+                SPRITE.unpack_from(data, offset)
+            offset += SPRITE.size
+            sprite_id = bytes(data[offset:offset + length]).decode('utf8')
+            offset += length
+            sprites.append((
+                SPRITE_CLASSES[code], sprite_id,
+                x, y, direction, interval, seq))
+
+        yield (X, Y, Z), tick, sprites
+
+
+def write(server, filename):
+    """Write a snapshot atomically."""
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(encode(server))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, filename)
+
+
+def read(filename):
+    """Get a list of ``(key, tick, sprites)`` for every map in a snapshot."""
+    with open(filename, 'rb') as fh:
+        return list(decode(fh.read()))
+
+
+def restore_users(server, maps):
+    """Remember the positions of all users in ``maps`` until they log in.
+
+    Users that are already logged in are skipped.
+    """
+    for key, tick, sprites in maps:
+        for cls, sprite_id, x, y, direction, interval, seq in sprites:
+            name = sprite_id.split(':', 1)[1]
+            if cls is User and name not in server.users:
+                server.saved_users[name] = (key, x, y)
+
+
+def restore_map(server, key, tick, sprites):
+    """Load a map and restore its sprites.
+
+    Sprites that already exist on the map (e.g. the initial ghost) are
+    replaced.  Users that have logged in in the meantime are kept.
+
+    """
+    _map = server.map_manager.get(*key)
+    _map.tick = tick
+    for sprite in list(_map.sprites.values()):
+        if not isinstance(sprite, User):
+            sprite.kill()
+
+    for cls, sprite_id, x, y, direction, interval, seq in sprites:
+        if cls is User:
+            continue
+
+        sprite = cls(sprite_id.split(':', 1)[1], _map, x, y)
+        sprite.interval = interval
+        if direction:
+            sprite.direction = direction
+        if sprite_id == 'Ghost:example':
+            _map.ghost = sprite
+
+
+def restore(server, filename):
+    """Restore the state from a snapshot at once.
+
+    Returns the number of restored maps.
+    """
+    maps = read(filename)
+    restore_users(server, maps)
+    for key, tick, sprites in maps:
+        restore_map(server, key, tick, sprites)
+    return len(maps)
+
+
+class Snapshotter(object):
+    """Take regular snapshots without blocking the mainloop."""
+
+    def __init__(self, server, filename):
+        self.server = server
+        self.filename = filename
+        self.pid = None
+
+    def busy(self):
+        """Check whether the last snapshot is still being written."""
+        if self.pid is not None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid == 0:
+                return True
+            self._check_status(status)
+            self.pid = None
+        return False
+
+    def _check_status(self, status):
+        if status != 0:
+            logger.error(
+                'Writing snapshot %s failed (wait status %i)',
+                self.filename, status)
+
+    def checkpoint(self, fork=True):
+        """Take a snapshot.
+
+        If the previous snapshot is still being written, this one is
+        skipped.  Returns whether a snapshot was started.
+
+        """
+        if self.busy():
+            return False
+
+        if fork and hasattr(os, 'fork'):
+            pid = os.fork()
+            if pid == 0:  # pragma: nocover
+                status = 1
+                try:
+                    write(self.server, self.filename)
+                    status = 0
+                finally:
+                    os._exit(status)
+            self.pid = pid
+        else:
+            write(self.server, self.filename)
+        return True
+
+    def close(self):
+        """Wait for a running snapshot to finish."""
+        if self.pid is not None:
+            pid, status = os.waitpid(self.pid, 0)
+            self._check_status(status)
+            self.pid = None
+
+
+__all__ = [
+    'Snapshotter',
+    'encode',
+    'decode',
+    'write',
+    'read',
+    'restore_users',
+    'restore_map',
+    'restore',
+]
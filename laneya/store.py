@@ -0,0 +1,193 @@
+"""Persistent storage for the tiles of all maps.
+
+All maps are stored in a single file that consists of a header followed by a
+sequence of fixed size records, one per map::
+
+    header:  magic (4 bytes), version, width, height (unsigned shorts),
+             world (uint)
+    record:  X, Y, Z (signed ints), width * height tile codes (1 byte each)
+
+``world`` is the :py:func:`seed_checksum` of the seed the maps were
+generated from.  A store can only be opened for the world it belongs to, so
+maps of different seeds never get mixed up.  Files of version 1 did not have
+this field; they are upgraded to the world they are opened for.
+
+The file is read through :py:mod:`mmap`, so only the pages of maps that are
+actually accessed are ever loaded from disk.  The index from coordinates to
+records is built on opening by reading only the record keys.
+
+Records are only ever appended.  If a map is stored again, the newer record
+wins.  A record that was only partially written (e.g. because the server
+crashed) is discarded the next time the file is opened, so every write is
+atomic.  :py:meth:`WorldStore.compact` can be used to get rid of outdated
+records.
+
+"""
+
+import os
+import mmap
+import zlib
+import struct
+
+MAGIC = b'LNYW'
+VERSION = 2
+
+HEADER = struct.Struct('<4sHHHI')
+HEADER_V1 = struct.Struct('<4sHHH')
+KEY = struct.Struct('<iii')
+
+# tile codes; the index in this list is stored on disk
+TILES = [None, 'floor', 'wall']
+TILE_CODES = {tile: code for code, tile in enumerate(TILES)}
+
+
+def encode_tiles(floor_layer):
+    """Convert a floor layer to a string of tile codes."""
+    return bytes(
+        TILE_CODES[tile] for column in floor_layer for tile in column)
+
+
+def seed_checksum(seed):
+    """Identify the world that is generated from ``seed``."""
+    return zlib.crc32(str(seed).encode('utf8'))
+
+
+def decode_tiles(data, width, height):
+    """Convert a string of tile codes to a floor layer."""
+    return [
+        [TILES[code] for code in data[x * height:(x + 1) * height]]
+        for x in range(width)]
+
+
+class WorldStore(object):
+    """Store for maps of ``width`` x ``height`` tiles.
+
+    ``width`` and ``height`` may be omitted to open an existing file with
+    whatever map size it has.  If ``world`` is omitted, the file is opened
+    for any world.
+    """
+
+    def __init__(self, filename, width=None, height=None, world=None):
+        self.filename = filename
+        self.index = {}
+        self._mmap = None
+
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as fh:
+                fh.write(HEADER.pack(
+                    MAGIC, VERSION, width, height, world or 0))
+
+        self._fh = open(filename, 'r+b')
+        magic, version = HEADER_V1.unpack(
+            self._fh.read(HEADER_V1.size))[:2]
+        if magic == MAGIC and version == 1:
+            self._upgrade(world or 0)
+        self._fh.seek(0)
+        magic, version, w, h, self.world = HEADER.unpack(
+            self._fh.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            self._fh.close()
+            raise ValueError('Not a world store: %s' % filename)
+        if width is None and height is None:
+            width, height = w, h
+        if (w, h) != (width, height):
+            self._fh.close()
+            raise ValueError('World store has a different map size')
+        if world is not None and world != self.world:
+            self._fh.close()
+            raise ValueError('World store belongs to a different seed')
+
+        self.width = width
+        self.height = height
+        self.tile_size = width * height
+        self.record_size = KEY.size + self.tile_size
+
+        size = os.fstat(self._fh.fileno()).st_size
+        count = (size - HEADER.size) // self.record_size
+        end = HEADER.size + count * self.record_size
+        if end != size:
+            # discard incomplete record
+            self._fh.truncate(end)
+
+        self._remap()
+        for i in range(count):
+            offset = HEADER.size + i * self.record_size
+            self.index[KEY.unpack_from(self._mmap, offset)] = offset
+
+    def _upgrade(self, world):
+        self._fh.seek(0)
+        data = self._fh.read()
+        _, _, width, height = HEADER_V1.unpack_from(data)
+
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, VERSION, width, height, world))
+            fh.write(data[HEADER_V1.size:])
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.filename)
+
+        self._fh.close()
+        self._fh = open(self.filename, 'r+b')
+
+    def _remap(self):
+        # the old mmap is not closed explicitly because there may still be
+        # memoryviews that reference it
+        self._mmap = mmap.mmap(
+            self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, X, Y, Z):
+        """Get a memoryview of the tile codes of a map or ``None``."""
+        offset = self.index.get((X, Y, Z))
+        if offset is not None:
+            start = offset + KEY.size
+            return memoryview(self._mmap)[start:start + self.tile_size]
+
+    def put(self, X, Y, Z, tiles):
+        """Store the tile codes of a map."""
+        self.put_many([((X, Y, Z), tiles)])
+
+    def put_many(self, items):
+        """Store the tile codes of many maps with a single fsync.
+
+        ``items`` is an iterable of ``(key, tiles)`` tuples.
+        """
+        self._fh.seek(0, os.SEEK_END)
+        index = {}
+        for key, tiles in items:
+            assert len(tiles) == self.tile_size
+            index[key] = self._fh.tell()
+            self._fh.write(KEY.pack(*key) + tiles)
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+        self._remap()
+        self.index.update(index)
+
+    def compact(self):
+        """Rewrite the file so it only contains the latest records."""
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(HEADER.pack(
+                MAGIC, VERSION, self.width, self.height, self.world))
+            index = {}
+            for key, offset in sorted(self.index.items()):
+                index[key] = fh.tell()
+                fh.write(self._mmap[offset:offset + self.record_size])
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.filename)
+
+        self._fh.close()
+        self._fh = open(self.filename, 'r+b')
+        self._remap()
+        self.index = index
+
+    def close(self):
+        self._fh.close()
+
+
+__all__ = ['WorldStore', 'encode_tiles', 'decode_tiles', 'seed_checksum']
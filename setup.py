@@ -10,12 +10,18 @@ setup(
     author='Tobias Bengfort',
     author_email='tobias.bengfort@posteo.de',
     packages=['laneya'],
+    python_requires='>=3.8',
     install_requires=[
         'dirtywords',
     ],
+    extras_require={
+        'uvloop': ['uvloop'],
+    },
     entry_points={'console_scripts': [
         'laneya=laneya.client:main',
         'laneyad=laneya.server:main',
+        'laneya-pregen=laneya.pregen:main',
+        'laneya-replay=laneya.replay:main',
     ]},
     license='GPLv2+',
     classifiers=[
@@ -23,6 +29,7 @@ setup(
         'Intended Audience :: End Users/Desktop',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
         'License :: OSI Approved :: GNU General Public License v2 or later '
             '(GPLv2+)',
         'Topic :: Games/Entertainment :: Role-Playing',
@@ -0,0 +1,51 @@
+import zlib
+import shutil
+import tempfile
+import unittest
+
+from laneya import store
+from laneya.cache import MapCache
+
+
+class TestMapCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.floor = [['wall', 'floor', 'floor'], ['wall', None, 'wall']]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_get(self):
+        cache = MapCache(self.tmpdir)
+        self.assertIsNone(cache.get('abc', (0, 0, 0)))
+
+        cache.put('abc', (0, -1, 0), self.floor)
+        cache.close()
+
+        cache = MapCache(self.tmpdir)
+        version, floor_layer = cache.get('abc', (0, -1, 0))
+        self.assertEqual(floor_layer, self.floor)
+        self.assertEqual(version, zlib.crc32(store.encode_tiles(self.floor)))
+        self.assertEqual(cache.get_version('abc', (0, -1, 0)), version)
+        self.assertIsNone(cache.get('def', (0, -1, 0)))
+        cache.close()
+
+    def test_size_changed(self):
+        cache = MapCache(self.tmpdir)
+        cache.put('abc', (0, 0, 0), self.floor)
+        cache.close()
+
+        cache = MapCache(self.tmpdir)
+        cache.put('abc', (1, 0, 0), [['floor', 'wall']])
+        self.assertIsNone(cache.get('abc', (0, 0, 0)))
+        self.assertEqual(cache.get('abc', (1, 0, 0))[1], [['floor', 'wall']])
+        cache.close()
+
+    def test_last(self):
+        cache = MapCache(self.tmpdir)
+        self.assertIsNone(cache.get_last('localhost:5001'))
+        cache.set_last('localhost:5001', 'abc', (1, 2, 3))
+
+        cache = MapCache(self.tmpdir)
+        self.assertEqual(
+            cache.get_last('localhost:5001'), ('abc', (1, 2, 3)))
@@ -0,0 +1,104 @@
+import sys
+import unittest
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+import laneya.map  # noqa: F401
+import laneya.cache  # noqa: F401
+from laneya import protocol
+
+# the client draws to a terminal on import.  Its dependencies are imported
+# first because patch.dict() removes all modules imported inside the block.
+with patch.dict(sys.modules, {'dirtywords': Mock()}):
+    from laneya import client
+
+
+class TestOutline(unittest.TestCase):
+    def test_get_outline(self):
+        floor_layer = [
+            ['wall', 'wall', 'wall', 'wall'],
+            ['wall', 'floor', 'floor', 'wall'],
+            ['wall', 'wall', 'wall', 'wall'],
+            ['wall', 'wall', 'wall', 'wall'],
+        ]
+        self.assertEqual(client.get_outline(floor_layer), set([
+            (0, 0), (0, 1), (0, 2), (0, 3),
+            (1, 0), (1, 3),
+            (2, 0), (2, 1), (2, 2), (2, 3),
+        ]))
+
+    def test_get_outline_border(self):
+        # fields outside of the map count as walls
+        self.assertEqual(client.get_outline([['floor', 'wall']]), set([
+            (0, 1)]))
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.loop = Mock()
+        self.loop.time.return_value = 0
+        self.client = client.Client(self.loop)
+        self.client.setup('foo')
+        self.client.send_request = Mock()
+        self.client.render_floor([['floor'] * 3 for i in range(3)])
+
+    def test_reconcile_own_position(self):
+        self.client.set_position('User:foo', 0, 0)
+        self.client.move('east')
+        self.assertEqual(self.client.sprites['User:foo']['x'], 1)
+
+        # the server has not processed the latest move yet
+        self.client.set_position('User:foo', 0, 0, seq=0)
+        self.assertEqual(self.client.sprites['User:foo']['x'], 1)
+
+        self.client.set_position('User:foo', 2, 0, seq=1)
+        self.assertEqual(self.client.sprites['User:foo']['x'], 2)
+
+    def test_no_rubber_banding(self):
+        self.client.render_floor([['floor'] * 10 for i in range(10)])
+        self.client.set_position('User:foo', 5, 5)
+        self.client.move('east')
+        self.client.predict()
+        self.client.predict()
+        self.assertEqual(self.client.sprites['User:foo']['x'], 8)
+
+        # acked, but one round trip behind the prediction
+        self.client.set_position('User:foo', 6, 5, seq=1)
+        self.assertEqual(self.client.sprites['User:foo']['x'], 8)
+
+        # once stopped, the server's position is final
+        self.client.move('stop')
+        self.client.set_position('User:foo', 7, 5, seq=2)
+        self.assertEqual(self.client.sprites['User:foo']['x'], 7)
+
+    def test_coalesced_move_response(self):
+        self.client.move('stop')
+        self.client._move_response({'data': {'coalesced': True}})
+        self.assertNotIn('User:foo', self.client.sprites)
+
+    def test_seed_from_move_response(self):
+        self.client.move('south')
+        self.assertNotIn('User:foo', self.client.sprites)
+
+        self.client._move_response({'data': {
+            'x': 1, 'y': 1, 'direction': 'south', 'seq': 1}})
+        self.client.predict()
+        self.assertEqual(self.client.sprites['User:foo'], {'x': 1, 'y': 2})
+
+    def test_interpolate(self):
+        self.client.set_position('Ghost:a', 0, 0)
+        self.client.set_position('Ghost:a', 2, 0)
+        self.assertEqual(self.client.sprites['Ghost:a']['x'], 0)
+
+        self.loop.time.return_value = protocol.TICK / 2
+        self.client.interpolate()
+        self.assertEqual(self.client.sprites['Ghost:a']['x'], 1)
+        self.assertIn('Ghost:a', self.client.interpolating)
+
+        self.loop.time.return_value = protocol.TICK
+        self.client.interpolate()
+        self.assertEqual(self.client.sprites['Ghost:a']['x'], 2)
+        self.assertNotIn('Ghost:a', self.client.interpolating)
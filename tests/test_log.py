@@ -0,0 +1,85 @@
+import io
+import json
+import logging
+import unittest
+
+from laneya import log
+
+
+def make_record(msg, *args, **extra):
+    record = logging.LogRecord(
+        'laneya', logging.ERROR, __file__, 0, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestRateLimitFilter(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.filter = log.RateLimitFilter(
+            burst=2, interval=1, sample=3, clock=lambda: self.now)
+
+    def test_burst_and_sample(self):
+        passed = [self.filter.filter(make_record('Invalid message: %s', i))
+            for i in range(8)]
+        self.assertEqual(passed, [
+            True, True, False, False, True, False, False, True])
+
+    def test_suppressed_count(self):
+        records = [make_record('Invalid message: %s', i) for i in range(5)]
+        for record in records:
+            self.filter.filter(record)
+        self.assertEqual(records[1].suppressed, 0)
+        self.assertEqual(records[4].suppressed, 2)
+
+    def test_categories(self):
+        for i in range(3):
+            self.filter.filter(make_record('foo'))
+        self.assertTrue(self.filter.filter(make_record('bar')))
+        self.assertTrue(self.filter.filter(make_record('foo', category='x')))
+
+    def test_window(self):
+        for i in range(3):
+            self.filter.filter(make_record('foo'))
+        self.now = 1
+        record = make_record('foo')
+        self.assertTrue(self.filter.filter(record))
+        self.assertEqual(record.suppressed, 1)
+
+
+class TestSetupLogging(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('laneya')
+        self.handlers = list(self.logger.handlers)
+        self.level = self.logger.level
+
+    def tearDown(self):
+        self.logger.handlers = self.handlers
+        self.logger.setLevel(self.level)
+
+    def test_structured(self):
+        stream = io.StringIO()
+        listener = log.setup_logging(structured=True, stream=stream)
+        logging.getLogger('laneya.server').info(
+            'login %s', 'alice', extra={'data': {'user': 'alice'}})
+        listener.stop()
+
+        data = json.loads(stream.getvalue())
+        self.assertEqual(data['message'], 'login alice')
+        self.assertEqual(data['user'], 'alice')
+        self.assertEqual(data['logger'], 'laneya.server')
+
+    def test_flood(self):
+        stream = io.StringIO()
+        listener = log.setup_logging(stream=stream)
+        for i in range(20):
+            self.logger.error('Invalid message: %s', i)
+        listener.stop()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 10)
+        self.assertTrue(lines[-1].endswith('Invalid message: 9'))
+
+
+if __name__ == '__main__':
+    unittest.main()
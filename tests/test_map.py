@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+from laneya import map as m
+
+
+class TestMap(unittest.TestCase):
+    def setUp(self):
+        self.server = Mock()
+        self.map = m.Map(self.server, 20, 20)
+        for x in range(20):
+            for y in range(20):
+                self.map.floor_layer[x][y] = 'floor'
+        self.map.ghost.kill()
+
+    def test_idle_sprite_sleeps(self):
+        user = m.User('test', self.map, 2, 2)
+        self.assertIn(user.id, self.map.active)
+
+        self.map.step()
+        self.assertNotIn(user.id, self.map.active)
+
+    def test_direction_wakes_sprite(self):
+        user = m.User('test', self.map, 2, 2)
+        self.map.step()
+
+        user.direction = m.EAST
+        self.assertIn(user.id, self.map.active)
+
+        self.map.step()
+        self.assertEqual((user.x, user.y), (3, 2))
+        self.assertIn(user.id, self.map.active)
+
+    def test_schedule(self):
+        step = Mock()
+
+        class Sprite(m.Sprite):
+            __slots__ = ()
+
+            def step(self):
+                step()
+
+        sprite = Sprite('test', self.map, 2, 2)
+        self.map.step()
+        self.map.schedule(sprite, 2)
+
+        self.map.step()
+        self.assertEqual(step.call_count, 1)
+        self.map.step()
+        self.assertEqual(step.call_count, 2)
+
+    def test_interval(self):
+        user = m.User('test', self.map, 0, 2)
+        user.interval = 4
+        user.direction = m.EAST
+
+        for i in range(8):
+            self.map.step()
+
+        self.assertEqual(user.x, 2)
+
+    def test_kill_removes_active(self):
+        user = m.User('test', self.map, 2, 2)
+        user.kill()
+        self.assertNotIn(user.id, self.map.active)
+
+    def test_slots(self):
+        user = m.User('test', self.map, 2, 2)
+        self.assertFalse(hasattr(user, '__dict__'))
+
+    def test_move_sprites_conflict(self):
+        first = m.User('first', self.map, 2, 2)
+        second = m.User('second', self.map, 4, 2)
+        first.direction = m.EAST
+        second.direction = m.WEST
+
+        self.map.step()
+
+        self.assertEqual((first.x, first.y), (3, 2))
+        self.assertEqual((second.x, second.y), (4, 2))
+        self.server.broadcast_update.assert_called_once_with(
+            'positions', positions=[['User:first', 3, 2, 0]])
+
+    def test_move_sprites_blocked(self):
+        first = m.User('first', self.map, 2, 2)
+        m.User('second', self.map, 3, 2)
+        first.direction = m.EAST
+
+        self.map.step()
+
+        self.assertEqual((first.x, first.y), (2, 2))
+        self.assertFalse(self.server.broadcast_update.called)
+
+    def test_move_sprites_edge(self):
+        user = m.User('test', self.map, 0, 2)
+        user.direction = m.WEST
+
+        self.map.step()
+
+        self.assertEqual((user.x, user.y), (0, 2))
+
+    def test_small_map(self):
+        # the example ghost is placed outside of maps this small
+        _map = m.Map(self.server, 10, 10)
+        self.assertNotIn(_map.ghost, sum(_map.movable_layer, []))
+        _map.ghost.direction = m.NORTH
+        _map.step()
+        _map.ghost.kill()
+        self.assertEqual(_map.sprites, {})
+
+
+class TestGenerate(unittest.TestCase):
+    def test_generate_floor_seeded(self):
+        floor = m.generate_floor(1, 0, 0, 0, 60, 40)
+        self.assertEqual(floor, m.generate_floor(1, 0, 0, 0, 60, 40))
+        self.assertNotEqual(floor, m.generate_floor(2, 0, 0, 0, 60, 40))
+        self.assertNotEqual(floor, m.generate_floor(1, 1, 0, 0, 60, 40))
+
+    def test_pregenerate(self):
+        cwd = os.getcwd()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.chdir(tmpdir)
+            map_manager = m.MapManager(Mock(), 60, 40, seed=1)
+            keys = [(0, 0, 0), (1, 0, 0)]
+            self.assertEqual(map_manager.pregenerate(keys, workers=2), 2)
+            self.assertEqual(map_manager.pregenerate(keys, workers=2), 0)
+
+            _map = map_manager.peek(1, 0, 0)
+            self.assertEqual(
+                _map.floor_layer, m.generate_floor(1, 1, 0, 0, 60, 40))
+            self.assertEqual(map_manager.store, {})
+            self.assertIsNone(map_manager.peek(2, 0, 0))
+
+            _map = map_manager.get(1, 0, 0)
+            self.assertEqual(
+                _map.floor_layer, m.generate_floor(1, 1, 0, 0, 60, 40))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
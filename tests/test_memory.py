@@ -0,0 +1,90 @@
+import json
+import unittest
+import tracemalloc
+
+from laneya import memory
+from laneya import protocol
+from laneya.server import Server
+
+
+class TestMemory(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(persist=False)
+
+    def test_sizeof(self):
+        a = [1, 2, 3]
+        self.assertGreater(memory.sizeof({'a': a}), memory.sizeof(a))
+        self.assertEqual(memory.sizeof([a, a]) - memory.sizeof([a]),
+            memory.sizeof([None, None]) - memory.sizeof([None]))
+
+    def test_report(self):
+        self.server.request_received('foo', 'move', direction='stop')
+        report = self.server.memory.report()
+        json.dumps(report)
+
+        self.assertEqual(report['maps'], 1)
+        self.assertEqual(report['orphaned_sprites'], 0)
+        self.assertGreater(report['parts']['maps.floor_layer'], 0)
+        self.assertGreater(report['parts']['sprites'], 0)
+        self.assertEqual(report['growth'], report['parts'])
+        self.assertEqual(report['total'], sum(report['parts'].values()))
+
+        self.server.request_received('bar', 'move', direction='stop')
+        report = self.server.memory.report()
+        self.assertGreater(report['growth']['sprites'], 0)
+        self.assertEqual(report['growth']['maps.floor_layer'], 0)
+
+    def test_orphaned_sprites(self):
+        self.server.request_received('foo', 'move', direction='stop')
+        del self.server.users['foo']
+        report = memory.account(self.server)
+        self.assertEqual(report['orphaned_sprites'], 1)
+
+    def test_admin(self):
+        with self.assertRaises(protocol.IllegalError):
+            self.server.request_received('foo', 'memory')
+
+        self.server.admin_token = 'secret'
+        with self.assertRaises(protocol.IllegalError):
+            self.server.request_received('foo', 'memory', token='wrong')
+
+        report = self.server.request_received('foo', 'memory', token='secret')
+        self.assertEqual(report['maps'], 0)
+        # admins are not logged in by their requests
+        self.assertNotIn('foo', self.server.users)
+
+    def test_spoofed_user(self):
+        # being started with an admin token does not trust any user name
+        self.server.admin_token = 'secret'
+        for user in ['admin', 'root', '']:
+            with self.assertRaises(protocol.IllegalError):
+                self.server.request_received(user, 'memory')
+        with self.assertRaises(protocol.IllegalError):
+            self.server.request_received('admin', 'memory', token='s\xe9')
+
+    def test_consumers(self):
+        self.server.memory.report(consumer='periodic')
+        self.server.request_received('foo', 'move', direction='stop')
+        self.server.admin_token = 'secret'
+        self.server.request_received('admin', 'memory', token='secret')
+
+        # the admin request did not reset the periodic baseline
+        report = self.server.memory.report(consumer='periodic')
+        self.assertGreater(report['growth']['sprites'], 0)
+
+    def test_tracemalloc(self):
+        self.server.memory.start_tracing()
+        try:
+            self.server.memory.report()
+            self.server.map_manager.get(1, 0, 0)
+            report = self.server.memory.report()
+        finally:
+            tracemalloc.stop()
+
+        self.assertGreater(report['tracemalloc']['current'], 0)
+        self.assertTrue(report['tracemalloc']['top'])
+        self.assertGreater(report['growth']['maps.floor_layer'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,444 @@
+import json
+import time
+import asyncio
+import unittest
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+from laneya import protocol
+
+
+class TestServerProtocol(unittest.TestCase):
+    def setUp(self):
+        self.factory = protocol.ServerProtocolFactory()
+        self.transport = Mock()
+        self.transport.is_closing.return_value = False
+        self.transport.get_write_buffer_size.return_value = 0
+        self.connection = self.factory.build_protocol()
+        self.connection.connection_made(self.transport)
+
+    def written(self):
+        return b''.join(
+            call[0][0] for call in self.transport.write.call_args_list)
+
+    def test_merge_positions_while_paused(self):
+        self.connection.pause_writing()
+        self.factory.broadcast_update(
+            'positions', positions=[['a', 1, 1, 0], ['b', 1, 2, 0]])
+        self.factory.broadcast_update(
+            'positions', positions=[['a', 2, 1, 0]])
+        self.assertFalse(self.transport.write.called)
+        self.assertEqual(self.connection.stats['merged'], 1)
+
+        self.connection.resume_writing()
+        self.assertEqual(self.transport.write.call_count, 1)
+        self.assertIn(b'[["a", 2, 1, 0], ["b", 1, 2, 0]]', self.written())
+
+    def test_disconnect_slow_consumer(self):
+        self.transport.get_write_buffer_size.return_value = 10 ** 7
+        self.factory.broadcast_update('position', x=1, y=1, entity='a')
+        self.transport.abort.assert_called_once_with()
+        self.assertFalse(self.transport.write.called)
+        self.assertEqual(self.connection.stats['disconnected'], 'slow')
+
+    def test_coalesce(self):
+        self.factory.request_received = Mock(return_value={'ok': True})
+        self.connection._send_response = Mock()
+
+        self.connection._write_response = Mock()
+        self.connection.flush = Mock()
+
+        self.connection._request_received(1, 'foo', 'move', direction='east')
+        self.connection._request_received(2, 'foo', 'move', direction='south')
+        self.connection._request_received(3, 'foo', 'move', direction='west')
+        self.connection._request_received(4, 'bar', 'move', direction='stop')
+        self.assertFalse(self.factory.request_received.called)
+        self.assertFalse(self.connection._write_response.called)
+
+        self.factory.flush_requests()
+        # superseded requests are acknowledged with a single flush
+        self.assertEqual(self.connection._write_response.call_args_list, [
+            ((1, 'success'), {'coalesced': True}),
+            ((2, 'success'), {'coalesced': True}),
+        ])
+        self.assertEqual(self.connection.flush.call_count, 1)
+        self.assertEqual(self.factory.request_received.call_count, 2)
+        self.factory.request_received.assert_any_call(
+            'foo', 'move', direction='west')
+        self.connection._send_response.assert_any_call(3, 'success', ok=True)
+        self.connection._send_response.assert_any_call(4, 'success', ok=True)
+
+    def test_rate_limit(self):
+        self.factory.request_received = Mock(return_value=None)
+        self.connection.request_burst = 2
+        self.connection.request_rate = 0
+
+        for key in range(3):
+            self.connection.json_received({
+                'type': 'request',
+                'key': key,
+                'user': 'foo',
+                'action': 'logout',
+                'data': {},
+            })
+
+        self.assertEqual(self.factory.request_received.call_count, 2)
+        self.assertEqual(self.connection.stats['rate_limited'], 1)
+        self.assertIn(b'rate limit exceeded', self.written())
+
+    def test_rate_limit_connection(self):
+        self.factory.request_received = Mock(return_value=None)
+        self.connection._bucket = protocol.TokenBucket(0, 3)
+
+        # changing the user name does not get around the limits
+        for key in range(protocol.ServerProtocol.max_users + 2):
+            self.connection.json_received({
+                'type': 'request',
+                'key': key,
+                'user': 'foo%i' % key,
+                'action': 'logout',
+                'data': {},
+            })
+
+        self.assertEqual(self.factory.request_received.call_count, 3)
+        self.assertEqual(
+            len(self.connection._buckets), protocol.ServerProtocol.max_users)
+        self.assertIn(b'too many users', self.written())
+
+    def test_raw_json_response(self):
+        self.factory.request_received = Mock(
+            return_value=protocol.RawJSON(b'{"foo": [1, 2]}'))
+        self.connection._request_received(1, 'foo', 'get_map', map_id='')
+
+        length, frame = self.written().split(b':', 1)
+        self.assertEqual(int(length) + 1, len(frame))
+        self.assertEqual(json.loads(frame[:-1].decode('utf8')), {
+            'type': 'response',
+            'key': 1,
+            'status': 'success',
+            'data': {'foo': [1, 2]},
+        })
+
+    def test_stats(self):
+        self.factory.broadcast_update('position', x=1, y=1, entity='a')
+        stats, = self.factory.get_stats()
+        self.assertEqual(stats['strings_sent'], 1)
+        self.assertEqual(stats['bytes_sent'], len(self.written()))
+
+    def test_memory_usage(self):
+        usage = self.connection.get_memory_usage()
+        self.assertEqual(usage['compression'], 0)
+
+        self.connection.start_compression()
+        self.transport.get_write_buffer_size.return_value = 100
+        usage = self.connection.get_memory_usage()
+        self.assertEqual(usage['compression'], protocol.ZLIB_DEFLATE_STATE)
+        self.assertEqual(usage['output_buffer'], 100)
+
+
+class TestValidate(unittest.TestCase):
+    def test_move_seq(self):
+        protocol.validate_action('move', {'direction': 'east', 'seq': 1})
+        # seq has to fit into snapshots
+        for seq in [-1, 2 ** 32, 1.5]:
+            self.assertRaises(
+                protocol.InvalidError, protocol.validate_action,
+                'move', {'direction': 'east', 'seq': seq})
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_consume(self):
+        now = [0]
+        bucket = protocol.TokenBucket(2, 3, clock=lambda: now[0])
+        self.assertTrue(bucket.consume(3))
+        self.assertFalse(bucket.consume())
+
+        now[0] = 1
+        self.assertTrue(bucket.consume(2))
+        self.assertFalse(bucket.consume())
+
+        now[0] = 10
+        self.assertTrue(bucket.consume(3))
+        self.assertFalse(bucket.consume())
+
+
+class TestConnectionRegistry(unittest.TestCase):
+    def test_bind(self):
+        registry = protocol.ConnectionRegistry()
+        registry.add('a')
+        registry.add('b')
+        registry.bind('foo', 'a')
+        registry.bind('foo', 'b')
+        self.assertEqual(registry.get('foo'), 'b')
+        self.assertEqual(registry.remove('a'), set())
+        self.assertEqual(registry.remove('b'), set(['foo']))
+        self.assertIsNone(registry.get('foo'))
+
+    def test_latest(self):
+        registry = protocol.ConnectionRegistry()
+        registry.add('a')
+        registry.add('b')
+        self.assertEqual(registry.latest(), 'b')
+        registry.remove('b')
+        self.assertEqual(registry.latest(), 'a')
+
+
+class TestAsync(unittest.TestCase):
+    def test_async_request_handler(self):
+        factory = protocol.ServerProtocolFactory()
+
+        async def request_received(user, action, **kwargs):
+            await asyncio.sleep(0)
+            return {'foo': 'bar'}
+
+        factory.request_received = request_received
+        connection = factory.build_protocol()
+        connection.connection_made(Mock())
+        connection._send_response = Mock()
+
+        async def main():
+            connection._request_received(1, 'user', 'logout')
+            await asyncio.sleep(0.01)
+
+        protocol.run(main(), loop='asyncio')
+        connection._send_response.assert_called_once_with(
+            1, 'success', foo='bar')
+
+    def test_looping_call(self):
+        fn = Mock()
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            call = protocol.LoopingCall(loop, fn)
+            call.start(0.01)
+            await asyncio.sleep(0.035)
+            call.stop()
+
+        protocol.run(main(), loop='asyncio')
+        self.assertGreaterEqual(fn.call_count, 3)
+
+    def test_run_legacy_interrupt(self):
+        finished = []
+
+        def interrupt():
+            raise KeyboardInterrupt
+
+        async def main():
+            asyncio.get_running_loop().call_soon(interrupt)
+            try:
+                await asyncio.sleep(10)
+            finally:
+                await asyncio.sleep(0)
+                finished.append(True)
+
+        with self.assertRaises(KeyboardInterrupt):
+            protocol._run_legacy(main(), asyncio.new_event_loop)
+        # pending tasks are cancelled so their cleanup code runs
+        self.assertEqual(finished, [True])
+
+    def test_unknown_loop(self):
+        self.assertRaises(ValueError, protocol.get_loop_factory, 'foo')
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.server = protocol.ServerProtocolFactory()
+        self.server.request_received = Mock(return_value={'foo': 'bar'})
+        self.server_transport = Mock()
+        self.server_transport.is_closing.return_value = False
+        self.server_transport.get_write_buffer_size.return_value = 0
+        self.server_connection = self.server.build_protocol()
+        self.server_connection.connection_made(self.server_transport)
+
+        self.client = protocol.ClientProtocolFactory(Mock())
+        self.client.setup('foo')
+        self.client.update_received = Mock()
+        self.client_transport = Mock()
+        self.client_connection = self.client.build_protocol()
+        self.client_connection.connection_made(self.client_transport)
+
+    def transfer(self):
+        for call in self.client_transport.write.call_args_list:
+            self.server_connection.data_received(call[0][0])
+        self.client_transport.write.reset_mock()
+
+        data = b''.join(
+            call[0][0] for call in self.server_transport.write.call_args_list)
+        self.server_transport.write.reset_mock()
+        self.client_connection.data_received(data)
+        return data
+
+    def test_compression(self):
+        handshake = Mock()
+        response = Mock()
+        self.client.handshake('zlib').then(handshake)
+        # the compressed response arrives in the same chunk as the handshake
+        self.client.send_request('logout').then(response)
+        self.transfer()
+
+        handshake.assert_called_once_with(
+            {'status': 'success', 'data': {'compression': 'zlib'}})
+        response.assert_called_once_with(
+            {'status': 'success', 'data': {'foo': 'bar'}})
+
+        for i in range(10):
+            self.server.broadcast_update(
+                'positions', positions=[['Ghost:example', i, 1, 0]])
+        self.assertFalse(self.server_transport.write.called)
+
+        self.server.flush_connections()
+        data = self.transfer()
+        self.assertEqual(self.client.update_received.call_count, 10)
+        self.assertLess(len(data), 150)
+        self.assertGreater(self.server_connection.stats['bytes_sent'], 700)
+
+    def test_late_handshake(self):
+        handshake = Mock()
+        self.client.handshake('zlib').catch(handshake)
+        # the response arrives after the request timed out
+        for key, promise in list(
+                self.client_connection._response_promises.items()):
+            self.client_connection._timeout(promise, key)
+        handshake.assert_called_once_with('timeout')
+
+        response = Mock()
+        self.client.send_request('logout').then(response)
+        self.transfer()
+        response.assert_called_once_with(
+            {'status': 'success', 'data': {'foo': 'bar'}})
+
+    def test_second_handshake(self):
+        self.client.handshake('zlib')
+        self.transfer()
+
+        handshake = Mock()
+        response = Mock()
+        self.client.handshake('zlib').catch(handshake)
+        self.client.send_request('logout').then(response)
+        self.transfer()
+
+        handshake.assert_called_once_with({
+            'status': 'illegal',
+            'data': {'message': 'compression is already active'},
+        })
+        response.assert_called_once_with(
+            {'status': 'success', 'data': {'foo': 'bar'}})
+
+
+class TestDatagram(unittest.TestCase):
+    def setUp(self):
+        self.factory = protocol.ServerProtocolFactory()
+        self.datagram_transport = Mock()
+        self.datagram_transport.is_closing.return_value = False
+        self.datagram_transport.get_extra_info.return_value = ('::1', 5001)
+        self.datagram = self.factory.build_datagram_protocol()
+        self.datagram.connection_made(self.datagram_transport)
+
+        self.transport = Mock()
+        self.transport.is_closing.return_value = False
+        self.transport.get_write_buffer_size.return_value = 0
+        self.connection = self.factory.build_protocol()
+        self.connection.connection_made(self.transport)
+
+    def test_authenticate(self):
+        self.connection._request_received(1, 'foo', 'datagram')
+        frame = self.transport.write.call_args[0][0]
+        response = json.loads(frame.split(b':', 1)[1][:-1].decode('utf8'))
+        self.assertEqual(response['data']['port'], 5001)
+
+        self.datagram.datagram_received(b'invalid', ('::1', 1234))
+        self.factory.broadcast_update('positions', positions=[])
+        self.assertFalse(self.datagram_transport.sendto.called)
+
+        token = response['data']['token'].encode('ascii')
+        self.datagram.datagram_received(token, ('::1', 1234))
+        self.factory.broadcast_update('positions', positions=[])
+        # the first update went over the stream and used seq 1
+        self.datagram_transport.sendto.assert_called_once_with(
+            b'[2, "positions", {"positions": []}]', ('::1', 1234))
+
+        # other updates still go over the stream
+        self.transport.write.reset_mock()
+        self.factory.broadcast_update('position', x=1, y=1, entity='a')
+        self.assertTrue(self.transport.write.called)
+
+    def test_keepalive_timeout(self):
+        self.connection._request_received(1, 'foo', 'datagram')
+        token = self.connection.datagram_token.encode('ascii')
+        self.datagram.datagram_received(token, ('::1', 1234))
+
+        # the client stopped sending keepalives
+        self.connection.datagram_seen -= self.connection.datagram_timeout + 1
+        self.transport.write.reset_mock()
+        self.factory.broadcast_update('positions', positions=[])
+        self.assertFalse(self.datagram_transport.sendto.called)
+        self.assertIn(b'"seq": 1', self.transport.write.call_args[0][0])
+
+        # the token stays valid for keepalives
+        self.datagram.datagram_received(token, ('::1', 1234))
+        self.factory.broadcast_update('positions', positions=[])
+        self.assertTrue(self.datagram_transport.sendto.called)
+
+    def test_drop_token(self):
+        self.connection._request_received(1, 'foo', 'datagram')
+        self.connection._request_received(2, 'foo', 'datagram')
+        self.assertEqual(len(self.factory._datagram_tokens), 1)
+
+        self.connection.connection_lost(None)
+        self.assertEqual(self.factory._datagram_tokens, {})
+
+    def test_client_keepalive(self):
+        client = protocol.DatagramClientProtocol(None, 'token')
+        transport = Mock()
+        transport.is_closing.return_value = False
+        client.connection_made(transport)
+
+        async def main():
+            client.keepalive_interval = 0.01
+            client.start_keepalive(asyncio.get_running_loop())
+            await asyncio.sleep(0.035)
+            client.connection_lost(None)
+
+        protocol.run(main(), loop='asyncio')
+        self.assertGreaterEqual(transport.sendto.call_count, 3 + 3)
+        self.assertFalse(client.keepalive.running)
+
+    def test_split_keyframes(self):
+        self.connection.datagram_addr = ('::1', 1234)
+        self.connection.datagram_seen = time.monotonic()
+        positions = [['Ghost:%i' % i, i, i, 0] for i in range(200)]
+        self.factory.broadcast_datagram('positions', positions=positions)
+
+        received = []
+        for call in self.datagram_transport.sendto.call_args_list:
+            payload = call[0][0]
+            self.assertLessEqual(len(payload), self.connection.max_datagram)
+            seq, action, data = json.loads(payload.decode('utf8'))
+            received += data['positions']
+        self.assertGreater(self.datagram_transport.sendto.call_count, 1)
+        self.assertEqual(received, positions)
+
+    def test_client_drops_old_positions(self):
+        factory = protocol.ClientProtocolFactory(None)
+        factory.update_received = Mock()
+        client = protocol.DatagramClientProtocol(factory, 'token')
+        client.connection_made(Mock())
+
+        client.datagram_received(
+            b'[2, "positions", {"positions": [["a", 2, 2, 0]]}]', None)
+        client.datagram_received(
+            b'[1, "positions", {"positions": [["a", 1, 1, 0], '
+            b'["b", 1, 1, 0]]}]', None)
+        client.datagram_received(b'[3, "foo", {}]', None)
+        client.datagram_received(b'garbage', None)
+
+        # a stale update over the stream does not win either
+        factory.positions_received(2, [['a', 3, 3, 0]])
+
+        self.assertEqual(
+            [call[1]['positions']
+                for call in factory.update_received.call_args_list],
+            [[['a', 2, 2, 0]], [['b', 1, 1, 0]]])
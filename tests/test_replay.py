@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from laneya import replay
+from laneya.server import Server
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replay(self):
+        server = Server(seed='test', persist=False)
+        server.recorder = replay.Recorder(self.filename, 'test')
+
+        server.request_received('foo', 'move', direction='east', seq=1)
+        for i in range(5):
+            server.mainloop()
+        server.request_received('bar', 'move', direction='south')
+        server.request_received('foo', 'move', direction='stop', seq=2)
+        for i in range(20):
+            server.mainloop()
+        server.request_received('bar', 'logout')
+        server.mainloop()
+        server.recorder.close(server)
+
+        replayed, expected, count = replay.replay(self.filename)
+        self.assertEqual(count, 4)
+        self.assertEqual(replayed.tick, 26)
+        self.assertEqual(expected, server.get_state_digest())
+        self.assertEqual(replayed.get_state_digest(), expected)
+
+    def test_replay_disconnect(self):
+        server = Server(seed='test', persist=False)
+        server.recorder = replay.Recorder(self.filename, 'test')
+
+        server.request_received('foo', 'move', direction='east', seq=1)
+        server.mainloop()
+        server.connection_lost(None, {'foo'})
+        server.mainloop()
+        server.recorder.close(server)
+
+        replayed, expected, count = replay.replay(self.filename)
+        self.assertNotIn('foo', replayed.users)
+        self.assertEqual(replayed.get_state_digest(), expected)
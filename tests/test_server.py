@@ -0,0 +1,171 @@
+import json
+import unittest
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+from laneya import map as m
+from laneya import protocol
+from laneya.server import Server
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.maps = {}
+        self.server.map_manager.get = self.get_map
+
+    def get_map(self, X, Y, Z):
+        key = (X, Y, Z)
+        if key not in self.maps:
+            self.maps[key] = m.Map(self.server, 60, 40)
+            self.maps[key].key = key
+        return self.maps[key]
+
+    def test_active_maps(self):
+        self.assertEqual(self.server.get_active_maps(), [])
+
+        self.server.request_received('foo', 'move', direction='stop')
+        self.server.request_received('bar', 'move', direction='stop')
+        _map = self.get_map(0, 0, 0)
+        self.assertEqual(self.server.get_active_maps(), [_map])
+        self.assertEqual(self.server.get_user_count(_map), 2)
+
+        self.server.request_received('foo', 'logout')
+        self.server.request_received('bar', 'logout')
+        self.assertEqual(self.server.get_active_maps(), [])
+
+    def test_move_user(self):
+        self.server.request_received('foo', 'move', direction='stop')
+        old_map = self.get_map(0, 0, 0)
+        new_map = self.get_map(1, 0, 0)
+
+        self.server.move_user('foo', new_map, 5, 5)
+        self.assertEqual(self.server.get_active_maps(), [new_map])
+        self.assertNotIn('User:foo', old_map.sprites)
+        self.assertIn('User:foo', new_map.sprites)
+
+    def test_dirty_maps(self):
+        self.server.request_received('foo', 'move', direction='stop')
+        _map = self.get_map(0, 0, 0)
+        _map.ghost.kill()
+        _map.step()
+        self.assertEqual(self.server.get_dirty_maps(), [])
+
+        _map.step = Mock()
+        self.server.mainloop()
+        self.assertFalse(_map.step.called)
+
+        self.server.request_received('foo', 'move', direction='east')
+        self.assertEqual(self.server.get_dirty_maps(), [_map])
+
+    def test_move_seq(self):
+        response = self.server.request_received(
+            'foo', 'move', direction='stop', seq=3)
+        self.assertEqual(response, {
+            'x': 10, 'y': 10, 'direction': 'stop', 'seq': 3})
+        self.assertEqual(self.server.users['foo'].seq, 3)
+
+    def test_connection_lost(self):
+        connection = self.server.build_protocol()
+        transport = Mock()
+        connection.connection_made(transport)
+        connection._request_received(1, 'foo', 'move', direction='stop')
+        self.assertIs(self.server.connections.get('foo'), connection)
+
+        connection.connection_lost(None)
+        self.assertNotIn('foo', self.server.users)
+        self.assertEqual(self.server.get_active_maps(), [])
+        self.assertIsNone(self.server.connections.get('foo'))
+
+    def test_logout_drops_deferred_move(self):
+        connection = self.server.build_protocol()
+        transport = Mock()
+        transport.is_closing.return_value = False
+        transport.get_write_buffer_size.return_value = 0
+        connection.connection_made(transport)
+
+        for key, action, data in [
+                (1, 'move', {'direction': 'stop'}),
+                (2, 'logout', {})]:
+            connection.json_received({
+                'type': 'request',
+                'key': key,
+                'user': 'foo',
+                'action': action,
+                'data': data,
+            })
+        self.server.mainloop()
+
+        self.assertEqual(self.server.users, {})
+        self.assertEqual(self.server.get_active_maps(), [])
+        written = b''.join(
+            call[0][0] for call in transport.write.call_args_list)
+        self.assertIn(b'"coalesced": true', written)
+
+    def test_warm_up(self):
+        self.server.map_manager.load_hot = Mock(return_value=[(1, 0, 0)])
+        self.server.map_manager.get = Mock()
+        loop = Mock()
+        loop.call_soon.side_effect = lambda fn: fn()
+
+        self.server.warm_up(loop)
+
+        self.assertEqual(
+            [call[0] for call in self.server.map_manager.get.call_args_list],
+            [(0, 0, 0), (1, 0, 0)])
+
+    def test_get_map_cache(self):
+        self.server.request_received('foo', 'move', direction='stop')
+        _map = self.get_map(0, 0, 0)
+
+        response = self.server.request_received('foo', 'get_map', map_id='')
+        self.assertIsInstance(response, protocol.RawJSON)
+        data = json.loads(response.decode('utf8'))
+        self.assertEqual(data['floor_layer'], _map.floor_layer)
+        self.assertEqual(data['version'], _map.version)
+        self.assertIs(_map.encode_json(), _map.encode_json())
+
+        response = self.server.request_received(
+            'foo', 'get_map', map_id='', version=_map.version)
+        self.assertTrue(response['not_modified'])
+        self.assertEqual(response['version'], _map.version)
+
+        _map.set_tile(0, 0, 'floor')
+        data = json.loads(self.server.request_received(
+            'foo', 'get_map', map_id='', version=data['version']))
+        self.assertEqual(data['floor_layer'][0][0], 'floor')
+
+    def test_get_map_adjacent(self):
+        self.server.request_received('foo', 'move', direction='stop')
+        neighbour = self.get_map(0, -1, 0)
+        self.server.map_manager.store[(0, -1, 0)] = neighbour
+
+        response = self.server.request_received(
+            'foo', 'get_map', map_id='', key=[0, -1, 0])
+        data = json.loads(response.decode('utf8'))
+        self.assertEqual(data['key'], [0, -1, 0])
+        self.assertEqual(data['version'], neighbour.version)
+
+        with self.assertRaises(protocol.IllegalError):
+            self.server.request_received(
+                'foo', 'get_map', map_id='', key=[1, 1, 0])
+
+        # maps that do not exist yet are not generated
+        self.server.map_manager.persist = False
+        with self.assertRaises(protocol.IllegalError):
+            self.server.request_received(
+                'foo', 'get_map', map_id='', key=[1, 0, 0])
+        self.assertNotIn((1, 0, 0), self.maps)
+
+    def test_publish_error(self):
+        self.server.request_received('foo', 'move', direction='east')
+        self.server.publisher = Mock()
+        self.server.publisher.publish.side_effect = FileExistsError
+        self.server.flush_connections = Mock()
+
+        self.server.mainloop()
+        self.assertTrue(self.server.flush_connections.called)
+        self.assertEqual(self.get_map(0, 0, 0).tick, 1)
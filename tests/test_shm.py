@@ -0,0 +1,63 @@
+import sys
+import unittest
+from multiprocessing import resource_tracker
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+from laneya import map as m
+from laneya import shm
+from laneya import store
+
+
+class TestSharedMemory(unittest.TestCase):
+    def setUp(self):
+        self.map = m.Map(Mock(), 20, 20)
+        self.map.key = (7, -1, 0)
+        for x in range(20):
+            for y in range(20):
+                self.map.floor_layer[x][y] = 'floor'
+        self.publisher = shm.MapPublisher()
+
+    def tearDown(self):
+        self.publisher.close()
+
+    def test_publish(self):
+        self.publisher.publish(self.map)
+        reader = shm.MapReader((7, -1, 0))
+        if sys.version_info < (3, 13):
+            # the reader unregistered the segment that is still owned by the
+            # publisher in this process
+            resource_tracker.register(reader.segment._name, 'shared_memory')
+
+        self.assertEqual(
+            bytes(reader.tiles), store.encode_tiles(self.map.floor_layer))
+        self.assertEqual(
+            reader.read(), (2, [('Ghost:example', 15, 15)]))
+
+        m.User('foo', self.map, 3, 4)
+        self.publisher.publish(self.map)
+        self.assertEqual(reader.read(), (4, [
+            ('Ghost:example', 15, 15),
+            ('User:foo', 3, 4),
+        ]))
+
+        reader.close()
+
+    def test_stale_segment(self):
+        other = shm.MapPublisher()
+        other.publish(self.map)
+        # simulate a crashed server that did not unlink its segment
+        stale = other.segments.pop(self.map.key)
+
+        self.publisher.publish(self.map)
+        stale.close()
+        self.assertIn(self.map.key, self.publisher.segments)
+
+    def test_encode_id(self):
+        self.assertEqual(shm.encode_id('User:foo'), b'User:foo')
+        b = shm.encode_id('User:' + 'ä' * 20)
+        self.assertEqual(len(b), 31)
+        b.decode('utf8')
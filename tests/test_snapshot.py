@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+from laneya import map as m
+from laneya import snapshot
+from laneya.server import Server
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_server(self):
+        server = Server()
+        maps = {}
+
+        def get_map(X, Y, Z):
+            if (X, Y, Z) not in maps:
+                maps[(X, Y, Z)] = m.Map(server, 60, 40)
+                server.map_manager.store[(X, Y, Z)] = maps[(X, Y, Z)]
+            return maps[(X, Y, Z)]
+
+        server.map_manager.get = get_map
+        return server
+
+    def test_restore(self):
+        server = self.create_server()
+        server.request_received('foo', 'move', direction='east', seq=2)
+        _map = server.map_manager.get(0, 0, 0)
+        _map.ghost.x = 17
+        _map.ghost.interval = 4
+        _map.tick = 42
+
+        snapshotter = snapshot.Snapshotter(server, self.filename)
+        self.assertTrue(snapshotter.checkpoint())
+        snapshotter.close()
+
+        restored = self.create_server()
+        self.assertEqual(snapshot.restore(restored, self.filename), 1)
+        _map = restored.map_manager.get(0, 0, 0)
+        self.assertEqual(_map.tick, 42)
+        self.assertEqual((_map.ghost.x, _map.ghost.y), (17, 15))
+        self.assertEqual(_map.ghost.interval, 4)
+        self.assertEqual(list(_map.sprites), ['Ghost:example'])
+        self.assertEqual(restored.saved_users, {'foo': ((0, 0, 0), 10, 10)})
+
+        restored.request_received('foo', 'move', direction='stop')
+        self.assertEqual(restored.saved_users, {})
+        self.assertIn('User:foo', _map.sprites)
+
+    def test_saved_users_roundtrip(self):
+        server = self.create_server()
+        server.saved_users['foo'] = ((1, 2, 3), 4, 5)
+        snapshot.write(server, self.filename)
+
+        restored = self.create_server()
+        snapshot.restore(restored, self.filename)
+        self.assertEqual(restored.saved_users, {'foo': ((1, 2, 3), 4, 5)})
+
+    def test_restore_in_background(self):
+        server = self.create_server()
+        server.request_received('foo', 'move', direction='stop')
+        server.map_manager.get(1, 0, 0).ghost.x = 17
+        snapshot.write(server, self.filename)
+
+        restored = self.create_server()
+        restored.map_manager.load_hot = lambda: []
+        maps = snapshot.read(self.filename)
+        snapshot.restore_users(restored, maps)
+        self.assertEqual(restored.saved_users, {'foo': ((0, 0, 0), 10, 10)})
+
+        calls = []
+        loop = Mock()
+        loop.call_soon.side_effect = calls.append
+        restored.warm_up(loop, maps)
+
+        # users can log in before their map has been restored
+        restored.request_received('foo', 'move', direction='stop')
+        while calls:
+            calls.pop(0)()
+
+        self.assertTrue(restored.ready)
+        self.assertIn('User:foo', restored.map_manager.get(0, 0, 0).sprites)
+        self.assertEqual(restored.map_manager.get(1, 0, 0).ghost.x, 17)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_failed_checkpoint(self):
+        server = self.create_server()
+        filename = os.path.join(self.tmpdir, 'missing', 'snapshot')
+        snapshotter = snapshot.Snapshotter(server, filename)
+
+        with self.assertLogs('laneya.snapshot', 'ERROR'):
+            self.assertTrue(snapshotter.checkpoint())
+            snapshotter.close()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from laneya import store
+
+
+class TestWorldStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'world')
+        self.floor = [['wall', 'floor', 'floor'], ['wall', None, 'wall']]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_encode_decode(self):
+        tiles = store.encode_tiles(self.floor)
+        self.assertEqual(len(tiles), 6)
+        self.assertEqual(store.decode_tiles(tiles, 2, 3), self.floor)
+
+    def test_put_get(self):
+        world = store.WorldStore(self.filename, 2, 3)
+        self.assertIsNone(world.get(0, 0, 0))
+
+        world.put(0, -1, 2, store.encode_tiles(self.floor))
+        tiles = world.get(0, -1, 2)
+        self.assertEqual(store.decode_tiles(tiles, 2, 3), self.floor)
+        world.close()
+
+        world = store.WorldStore(self.filename, 2, 3)
+        tiles = world.get(0, -1, 2)
+        self.assertEqual(store.decode_tiles(tiles, 2, 3), self.floor)
+        world.close()
+
+    def test_latest_wins(self):
+        world = store.WorldStore(self.filename, 2, 3)
+        world.put(0, 0, 0, b'\0' * 6)
+        world.put(0, 0, 0, store.encode_tiles(self.floor))
+        self.assertEqual(bytes(world.get(0, 0, 0)), b'\2\1\1\2\0\2')
+
+        world.compact()
+        self.assertEqual(
+            os.path.getsize(self.filename), store.HEADER.size + 12 + 6)
+        self.assertEqual(bytes(world.get(0, 0, 0)), b'\2\1\1\2\0\2')
+        world.close()
+
+    def test_incomplete_record(self):
+        world = store.WorldStore(self.filename, 2, 3)
+        world.put(0, 0, 0, b'\1' * 6)
+        world.close()
+
+        with open(self.filename, 'ab') as fh:
+            fh.write(b'\0' * 8)
+
+        world = store.WorldStore(self.filename, 2, 3)
+        self.assertEqual(list(world.index), [(0, 0, 0)])
+        world.put(1, 0, 0, b'\2' * 6)
+        self.assertEqual(bytes(world.get(1, 0, 0)), b'\2' * 6)
+        world.close()
+
+    def test_size_mismatch(self):
+        store.WorldStore(self.filename, 2, 3).close()
+        self.assertRaises(ValueError, store.WorldStore, self.filename, 3, 2)
+
+    def test_seed_mismatch(self):
+        store.WorldStore(self.filename, 2, 3, world=1).close()
+        self.assertRaises(
+            ValueError, store.WorldStore, self.filename, 2, 3, world=2)
+        store.WorldStore(self.filename, 2, 3).close()
+
+    def test_upgrade(self):
+        with open(self.filename, 'wb') as fh:
+            fh.write(store.HEADER_V1.pack(store.MAGIC, 1, 2, 3))
+            fh.write(store.KEY.pack(0, 0, 0) + b'\1' * 6)
+
+        world = store.WorldStore(self.filename, 2, 3, world=5)
+        self.assertEqual(world.world, 5)
+        self.assertEqual(bytes(world.get(0, 0, 0)), b'\1' * 6)
+        world.close()
+
+    def test_put_many(self):
+        world = store.WorldStore(self.filename, 2, 3)
+        world.put_many([((0, 0, 0), b'\1' * 6), ((1, 0, 0), b'\2' * 6)])
+        world.close()
+
+        world = store.WorldStore(self.filename, 2, 3)
+        self.assertEqual(bytes(world.get(1, 0, 0)), b'\2' * 6)
+        world.close()